@@ -0,0 +1,343 @@
+"""A local stand-in for the api-football endpoints (and the logos) used by the app.
+
+The responses are replayed from the teams, competitions, matches, and searches in the sample dump, optionally
+with synthetic competitions to scale the calendars up to thousands of matches.
+The dump's matches are moved forward in time so the newest calendar looks like it was cached just now.
+"""
+
+import json
+import threading
+from collections import Counter, defaultdict
+from dataclasses import replace
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Any, List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+from dump import load_rows
+
+import cache
+from custom_types import Competition, Match, Team
+
+# The ids of the synthetic teams, competitions, and matches start here so they don't clash with real ones.
+SYNTHETIC_ID = 900000
+
+# A (tiny, but valid) PNG served for every logo.
+LOGO_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000b49444154789c6360000200000500017a5eab3f0000000049454e44ae426082"
+)
+
+
+class World:
+    """The teams, competitions, and matches the stub knows about."""
+
+    def __init__(self):
+        self.teams: dict[int, Team] = {}
+        self.comps: dict[int, Competition] = {}
+        self.matches: dict[int, Match] = {}
+        # The calendars worth requesting, as (team, id) pairs.
+        self.calendars: List[tuple[bool, str]] = []
+        # The queries recorded in the dump, as (team, query) pairs.
+        self.searches: List[tuple[bool, str]] = []
+        self._by_team: dict[int, List[Match]] = defaultdict(list)
+        self._by_league: dict[int, List[Match]] = defaultdict(list)
+
+    def add_match(self, m: Match) -> None:
+        self.matches[m.id] = m
+        self._by_team[int(m.home_team_id)].append(m)
+        self._by_team[int(m.away_team_id)].append(m)
+        self._by_league[int(m.league_id)].append(m)
+
+    def load_dump(self, now: Optional[datetime] = None) -> None:
+        """Adds everything in the sample dump, moved forward so its newest entry was cached at `now`."""
+        now = now or datetime.utcnow()
+        entries = [(key, *cache.decode(raw)) for key, raw in load_rows()]
+        shift = timedelta(days=(now - max(ts for *unused, ts in entries)).days)
+
+        for key, value, unused_ts in entries:
+            kind, _, rest = key.partition("/")
+            if not value:
+                continue
+            if kind in ("team-search", "comp-search"):
+                self.searches.append((kind == "team-search", rest))
+                for entity in value:
+                    self._add_entity(entity, shift)
+            elif kind in ("team-cal", "comp-cal"):
+                self.calendars.append((kind == "team-cal", rest))
+                self._add_entity(value["info"], shift)
+                for m in value["matches"]:
+                    if m.id not in self.matches:
+                        self.add_match(
+                            replace(
+                                m,
+                                match_utc_ts=int(
+                                    m.match_utc_ts + shift.total_seconds()
+                                ),
+                            )
+                        )
+
+    def _add_entity(self, entity: Any, shift: timedelta) -> None:
+        if isinstance(entity, Team):
+            self.teams[entity.id] = entity
+        else:
+            self.comps[entity.id] = replace(
+                entity,
+                season_start=_shift_date(entity.season_start, shift),
+                season_end=_shift_date(entity.season_end, shift),
+            )
+
+    def add_synthetic(
+        self, comps: int, teams_per_comp: int, now: Optional[datetime] = None
+    ) -> None:
+        """Adds competitions where every team plays every other team twice, starting a week ago."""
+        now = now or datetime.utcnow()
+        start = datetime(now.year, now.month, now.day) - timedelta(weeks=1)
+        next_match_id = SYNTHETIC_ID * 100 + len(self.matches)
+        for c in range(comps):
+            league_id = SYNTHETIC_ID + c
+            comp = Competition(
+                id=league_id,
+                name=f"Synthetic League {c + 1}",
+                type="League",
+                country_name="Synthland",
+                country_code="SY",
+                season=now.year,
+                season_start=start.date().isoformat(),
+                season_end=(start + timedelta(days=365)).date().isoformat(),
+                logo=f"https://media.api-sports.io/football/leagues/{league_id}.png",
+            )
+            self.comps[league_id] = comp
+            self.calendars.append((False, str(league_id)))
+
+            teams = []
+            for i in range(teams_per_comp):
+                team_id = SYNTHETIC_ID * 10 + c * 1000 + i
+                teams.append(
+                    Team(
+                        id=team_id,
+                        name=f"Synthetic {c + 1} FC {i + 1}",
+                        short_name=f"S{i + 1}",
+                        country="Synthland",
+                        founded=1900 + i,
+                        club=True,
+                        logo=f"https://media.api-sports.io/football/teams/{team_id}.png",
+                    )
+                )
+                self.teams[team_id] = teams[-1]
+                self.calendars.append((True, str(team_id)))
+            self.searches.append((True, f"Synthetic {c + 1} FC"))
+
+            for r, pairs in enumerate(_double_round_robin(teams)):
+                for k, (home, away) in enumerate(pairs):
+                    kickoff = start + timedelta(days=2 * r, hours=12 + 2 * (k % 5))
+                    played = kickoff + timedelta(hours=2) < now
+                    self.add_match(
+                        Match(
+                            id=next_match_id,
+                            ref_name="Synthetic Referee",
+                            match_utc_ts=int(
+                                kickoff.replace(tzinfo=timezone.utc).timestamp()
+                            ),
+                            venue_id=home.id,
+                            venue_name=f"{home.name} Stadium",
+                            venue_city="Synthcity",
+                            league_id=league_id,
+                            league_name=comp.name,
+                            home_team_id=home.id,
+                            away_team_id=away.id,
+                            home_team_name=home.name,
+                            away_team_name=away.name,
+                            status="FT" if played else "NS",
+                            home_score=(r + k) % 4 if played else None,
+                            away_score=(r * k) % 3 if played else None,
+                            season=comp.season,
+                        )
+                    )
+                    next_match_id += 1
+
+    def fixtures(self, params: dict[str, str]) -> List[Match]:
+        if "ids" in params:
+            ids = [int(id) for id in params["ids"].split("-")]
+            return [self.matches[id] for id in ids if id in self.matches]
+
+        if "team" in params:
+            found = sorted(
+                self._by_team.get(int(params["team"]), []),
+                key=lambda m: m.match_utc_ts,
+            )
+        else:
+            found = self._by_league.get(int(params.get("league", 0)), [])
+
+        now_ts = datetime.now(timezone.utc).timestamp()
+        if "next" in params:
+            return [m for m in found if m.match_utc_ts >= now_ts][: int(params["next"])]
+        if "last" in params:
+            return [m for m in found if m.match_utc_ts < now_ts][-int(params["last"]) :]
+        if "from" in params and "to" in params:
+            start = _date_ts(params["from"])
+            end = _date_ts(params["to"]) + 24 * 3600
+            return [m for m in found if start <= m.match_utc_ts < end]
+        return list(found)
+
+    def search(self, entities: dict[int, Any], query: str) -> List[Any]:
+        # api-football returns the names that contain the query.
+        query = query.lower()
+        return [e for e in entities.values() if query in e.name.lower()]
+
+    def respond(self, endpoint: str, params: dict[str, str]) -> List[dict]:
+        """Returns the `response` part of the api-football answer to the request."""
+        if endpoint == "fixtures":
+            return [_match_json(m, self.comps) for m in self.fixtures(params)]
+        if endpoint == "teams":
+            if "id" in params:
+                team = self.teams.get(int(params["id"]))
+                return [_team_json(team)] if team is not None else []
+            return [_team_json(t) for t in self.search(self.teams, params["search"])]
+        if endpoint == "leagues":
+            if "id" in params:
+                comp = self.comps.get(int(params["id"]))
+                return [_comp_json(comp)] if comp is not None else []
+            return [_comp_json(c) for c in self.search(self.comps, params["search"])]
+        return []
+
+
+def _double_round_robin(teams: List[Team]) -> List[List[tuple[Team, Team]]]:
+    # Circle method: one team stays put while the others rotate around it.
+    rotation = list(teams) + ([None] if len(teams) % 2 else [])
+    rounds = []
+    for unused in range(len(rotation) - 1):
+        half = len(rotation) // 2
+        pairs = [
+            (rotation[i], rotation[-1 - i])
+            for i in range(half)
+            if rotation[i] is not None and rotation[-1 - i] is not None
+        ]
+        rounds.append(pairs)
+        rotation.insert(1, rotation.pop())
+    return rounds + [[(away, home) for home, away in pairs] for pairs in rounds]
+
+
+def _shift_date(iso: Optional[str], shift: timedelta) -> Optional[str]:
+    if not iso:
+        return iso
+    return (date.fromisoformat(iso) + shift).isoformat()
+
+
+def _date_ts(iso: str) -> int:
+    return int(datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _match_json(m: Match, comps: dict[int, Competition]) -> dict:
+    comp = comps.get(int(m.league_id))
+    return {
+        "fixture": {
+            "id": m.id,
+            "referee": m.ref_name,
+            "timestamp": m.match_utc_ts,
+            "venue": {"id": m.venue_id, "name": m.venue_name, "city": m.venue_city},
+            "status": {"short": m.status},
+        },
+        "league": {
+            "id": m.league_id,
+            "name": m.league_name,
+            "season": m.season or (comp.season if comp is not None else None),
+        },
+        "teams": {
+            "home": {"id": m.home_team_id, "name": m.home_team_name},
+            "away": {"id": m.away_team_id, "name": m.away_team_name},
+        },
+        "score": {"fulltime": {"home": m.home_score, "away": m.away_score}},
+    }
+
+
+def _team_json(t: Team) -> dict:
+    return {
+        "team": {
+            "id": t.id,
+            "name": t.name,
+            "code": t.short_name,
+            "country": t.country,
+            "founded": t.founded,
+            "national": not t.club,
+            "logo": t.logo,
+        }
+    }
+
+
+def _comp_json(c: Competition) -> dict:
+    return {
+        "league": {"id": c.id, "name": c.name, "type": c.type, "logo": c.logo},
+        "country": {"name": c.country_name, "code": c.country_code},
+        "seasons": [{"year": c.season, "start": c.season_start, "end": c.season_end}],
+    }
+
+
+class Stub:
+    """Serves a world over HTTP, answering each request after the given latency."""
+
+    def __init__(self, world: World, latency_s: float = 0.0):
+        self.world = world
+        self.latency_s = latency_s
+        # How many requests each endpoint got.
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/v3"
+
+    @property
+    def logo_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/football"
+
+    def start(self) -> "Stub":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _answer(self, path: str, params: dict[str, str]) -> tuple[int, str, bytes]:
+        parts = path.strip("/").split("/")
+        if parts[0] == "football":
+            with self._lock:
+                self.calls["logo"] += 1
+            return 200, "image/png", LOGO_PNG
+
+        endpoint = parts[-1]
+        with self._lock:
+            self.calls[endpoint] += 1
+        response = self.world.respond(endpoint, params)
+        body = json.dumps({"get": endpoint, "parameters": params, "response": response})
+        return 200, "application/json", body.encode("utf8")
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                sleep(stub.latency_s)
+                status, content_type, body = stub._answer(
+                    url.path, dict(parse_qsl(url.query))
+                )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                # Never let the quota run out because of what the stub reports.
+                self.send_header("x-ratelimit-requests-limit", "1000000000")
+                self.send_header("x-ratelimit-requests-remaining", "1000000000")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
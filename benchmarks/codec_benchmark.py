@@ -0,0 +1,58 @@
+"""Compares the size and encode/decode time of the cache codecs on the sample dump.
+
+Usage: python3 benchmarks/codec_benchmark.py [--repeat N]
+"""
+
+import argparse
+from collections import defaultdict
+from time import perf_counter
+
+from dump import load_rows
+
+import cache
+
+
+def _kind(key: str) -> str:
+    return key.split("/", 1)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = load_rows()
+    entries = [(key, cache.decode(raw)) for key, raw in rows]
+
+    print(f"{len(rows)} rows, {args.repeat} repetitions\n")
+    print(
+        f"{'codec':<12} {'kind':<12} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}"
+    )
+    for name, codec in cache.codecs.items():
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        for key, (value, ts) in entries:
+            start = perf_counter()
+            for _ in range(args.repeat):
+                raw = codec.encode(value, ts)
+            encoded = perf_counter()
+            for _ in range(args.repeat):
+                decoded = codec.decode(raw)
+            done = perf_counter()
+
+            # Make sure the codec round-trips the values from the dump.
+            assert decoded == (value, ts), f"{name} changed the value for {key}"
+
+            for kind in (_kind(key), "total"):
+                totals[kind][0] += len(raw)
+                totals[kind][1] += (encoded - start) / args.repeat
+                totals[kind][2] += (done - encoded) / args.repeat
+
+        for kind, (size, enc, dec) in sorted(totals.items()):
+            print(
+                f"{name:<12} {kind:<12} {size:>10} {enc * 1e3:>10.2f} {dec * 1e3:>10.2f}"
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import re
+import sys
+from pathlib import Path
+from typing import List
+
+# Make the app modules importable the same way they import each other.
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "footcal"))
+
+DUMP_PATH = ROOT / "testdb" / "footcal-db-dump" / "dump.sql"
+
+# Matches one row of the `cached_data` INSERT statement in the dump.
+_ROW_RE = re.compile(r"^\('((?:[^'\\]|\\.)*)', '((?:[^'\\]|\\.)*)'\)[,;]$")
+
+
+def _unescape(s: str) -> str:
+    return re.sub(r"\\(.)", lambda m: m.group(1), s)
+
+
+def load_rows(path: Path = DUMP_PATH) -> List[tuple[str, bytes]]:
+    """Returns the (objkey, data) rows of the `cached_data` table in the sample dump."""
+    rows = []
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            m = _ROW_RE.match(line.rstrip("\n"))
+            if m:
+                rows.append(
+                    (_unescape(m.group(1)), _unescape(m.group(2)).encode("utf8"))
+                )
+    return rows
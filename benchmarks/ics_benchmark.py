@@ -0,0 +1,148 @@
+"""Checks that the ics writer matches icalendar byte for byte and compares how long both take.
+
+Every calendar in the sample dump is rendered with both, plus a few made-up calendars with names that need
+escaping and folding (commas, semicolons, backslashes, newlines, and multi-byte characters).
+The ics writer is checked and timed with and without the events it already wrote for other versions.
+
+Usage: python3 benchmarks/ics_benchmark.py [--repeat N]
+"""
+
+import argparse
+import sys
+from dataclasses import replace
+from datetime import datetime
+from time import perf_counter
+from zoneinfo import ZoneInfo
+
+from dump import load_rows
+from icalendar import Calendar, Event
+
+import cache
+import ics
+from custom_types import Team
+
+
+def reference_calendar(cache_data: dict, dtstamp: datetime) -> bytes:
+    """The calendar as it was built with icalendar before the ics writer."""
+    dtstamp = dtstamp.replace(tzinfo=ZoneInfo("UTC"))
+    cal = Calendar()
+    cal.add("PRODID", "-//Footcal//footcal.cbdm.app//EN")
+    cal.add("VERSION", "2.0")
+    cal.add("CALSCALE", "GREGORIAN")
+    cal.add("METHOD", "PUBLISH")
+    cal.add("X-WR-CALNAME", cache_data["info"].name)
+    cal.add("X-WR-TIMEZONE", "UTC")
+    for m in cache_data["matches"]:
+        e = Event()
+        start_dt = datetime.fromtimestamp(m.match_utc_ts, tz=ZoneInfo("UTC"))
+        e.add("DTSTART", start_dt)
+        e.add("DTEND", start_dt + ics.MATCH_DURATION)
+        e.add("DTSTAMP", dtstamp)
+        local_uid = f"{start_dt.date()}_{m.league_id}_{m.home_team_id}_{m.away_team_id}"
+        local_uid = local_uid.replace(" ", "_")
+        e.add("UID", f"{local_uid}@footcal.cbdm.app")
+        e.add("CREATED", dtstamp)
+        e.add("DESCRIPTION", f"Ref: {m.ref_name}")
+        e.add("LAST-MODIFIED", dtstamp)
+        e.add("LOCATION", f"{m.venue_name}, {m.venue_city}")
+        e.add("SEQUENCE", 0)
+        e.add("STATUS", "CONFIRMED")
+        e.add("SUMMARY", f"[{m.league_name}] {ics.match_teams(m)}")
+        e.add("TRANSP", "OPAQUE")
+        cal.add_component(e)
+    return cal.to_ical(sorted=False)
+
+
+# Names that exercise the escaping and folding rules.
+_TRICKY_NAMES = [
+    "Brighton & Hove Albion, the; \\ back\\N slash",
+    "Line\nbreak and\r\nCRLF",
+    "São Paulo Futebol Clube — Atlético Mineiro — Grêmio Foot-Ball Porto Alegrense",
+    "x" * 200,
+    "Ünïcödé " * 20,
+    "日本代表 サッカー 全日本 " * 5,
+    "emoji ⚽🏆 " * 12,
+]
+
+
+def _calendars() -> list[tuple[str, dict]]:
+    calendars = []
+    for key, raw in load_rows():
+        value, unused_ts = cache.decode(raw)
+        if key.split("/", 1)[0] in ("team-cal", "comp-cal") and value:
+            calendars.append((key, value))
+
+    # Use the biggest calendar's matches with made-up names.
+    key, biggest = max(calendars, key=lambda c: len(c[1]["matches"]))
+    team = Team(1, "", "", "", 1900, True, "")
+    for i, name in enumerate(_TRICKY_NAMES):
+        tricky_matches = [
+            replace(
+                m,
+                home_team_name=name,
+                venue_name=name,
+                league_name=name[: 10 + i],
+                ref_name=None if i % 2 else name,
+            )
+            for m in biggest["matches"]
+        ]
+        calendars.append(
+            (
+                f"tricky/{i}",
+                {"info": replace(team, name=name), "matches": tricky_matches},
+            )
+        )
+    return calendars
+
+
+def _time(fn, repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    calendars = _calendars()
+    dtstamp = datetime(2024, 5, 28, 12, 34, 56, 789012)
+
+    mismatches = 0
+    for key, value in calendars:
+        expected = reference_calendar(value, dtstamp)
+        ics.clear_fragments()
+        cold = ics.calendar(value, dtstamp)
+        ics.calendar(value, datetime(2024, 1, 1))
+        warm = ics.calendar(value, dtstamp)
+        if cold != expected or warm != expected:
+            print(f"MISMATCH: {key}")
+            mismatches += 1
+    print(f"{len(calendars) - mismatches}/{len(calendars)} calendars match icalendar\n")
+
+    # Cold: every event is written from scratch; warm: the events were written for another version.
+    print(
+        f"{'calendar':<16} {'events':>7} {'icalendar ms':>13} {'cold ms':>8} {'warm ms':>8}"
+    )
+    biggest = sorted(calendars, key=lambda c: -len(c[1]["matches"]))[:5]
+    for key, value in biggest:
+        ref_ms = _time(lambda: reference_calendar(value, dtstamp), args.repeat)
+
+        def cold():
+            ics.clear_fragments()
+            ics.calendar(value, dtstamp)
+
+        cold_ms = _time(cold, args.repeat)
+        ics.calendar(value, datetime(2024, 1, 1))
+        warm_ms = _time(lambda: ics.calendar(value, dtstamp), args.repeat)
+        print(
+            f"{key:<16} {len(value['matches']):>7} {ref_ms:>13.2f} {cold_ms:>8.2f} {warm_ms:>8.2f}"
+        )
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""Load tests the app's routes with concurrent clients, against a local database and the api-football stub.
+
+The stub (see api_stub.py) replays the sample dump, plus synthetic competitions if asked to.
+Every route is measured in two scenarios, each in a new process with a new database (SQLite unless --db-url is given):
+- cold: nothing is cached, so every URL is requested once and has to be fetched from the stub;
+- warm: every URL was requested once already, so the data is in the database and in the process' caches.
+
+The throughput, latency percentiles, and upstream calls of each route are printed and saved as JSON, and can be
+compared with a previous run using --compare.
+
+Usage: python3 benchmarks/load_benchmark.py [--clients N] [--requests N] [--synthetic-comps N] [--output FILE]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from math import ceil
+from pathlib import Path
+from time import perf_counter, sleep
+
+from dump import ROOT
+
+SCENARIOS = ("cold", "warm")
+ROUTES = ("feed", "next", "index", "search", "logo")
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _requests(world, route: str) -> list[tuple[str, str, dict]]:
+    """Returns the (method, path, form) of every distinct request for the route."""
+    if route == "index":
+        return [("GET", "/", None)]
+    if route == "search":
+        return [
+            ("POST", "/search/", {"query": q, "gridRadios": "teams" if t else "comps"})
+            for t, q in world.searches
+        ]
+    paths = {
+        "feed": "/{type}/{id}/calendar.ics",
+        "next": "/next/{type}/{id}/",
+        "logo": "/logo/{type}/{id}/",
+    }
+    return [
+        ("GET", paths[route].format(type="team" if t else "comp", id=id), None)
+        for t, id in world.calendars
+    ]
+
+
+def _percentile(sorted_values: list[float], p: float) -> float:
+    # Nearest rank, so it's always one of the measured values.
+    return sorted_values[max(0, ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def _summarize(samples: list[tuple[float, int, int]], elapsed_s: float) -> dict:
+    latencies = sorted(s[0] * 1000 for s in samples)
+    statuses = {}
+    for unused, status, unused_size in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        # Failed requests are recorded with a status of 0.
+        "errors": sum(1 for s in samples if s[1] == 0 or s[1] >= 500),
+        "statuses": statuses,
+        "throughput_rps": len(samples) / elapsed_s if elapsed_s else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies),
+            **{f"p{p}": _percentile(latencies, p) for p in PERCENTILES},
+            "max": latencies[-1],
+        },
+        "mean_bytes": sum(s[2] for s in samples) / len(samples),
+    }
+
+
+def _load(base_url: str, reqs: list, clients: int, accept_encoding: str) -> tuple:
+    """Sends the requests with the given number of concurrent clients and returns the samples and elapsed time."""
+    import requests
+
+    local = threading.local()
+
+    def send(req):
+        method, path, form = req
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.headers["Accept-Encoding"] = accept_encoding
+        start = perf_counter()
+        try:
+            resp = local.session.request(method, base_url + path, data=form)
+            size = len(resp.content)
+            status = resp.status_code
+        except requests.RequestException:
+            size, status = 0, 0
+        return perf_counter() - start, status, size
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        samples = list(pool.map(send, reqs))
+    return samples, perf_counter() - start
+
+
+def _wait_for_background() -> None:
+    import background
+
+    while background._pending:
+        sleep(0.01)
+
+
+def _empty_database(url: str) -> None:
+    from sqlalchemy import MetaData, create_engine
+
+    engine = create_engine(url)
+    metadata = MetaData()
+    metadata.reflect(engine)
+    with engine.begin() as conn:
+        for table in reversed(metadata.sorted_tables):
+            conn.execute(table.delete())
+    engine.dispose()
+
+
+def run_scenario(scenario: str, route: str, args) -> dict:
+    """Starts the app in this process and measures one route."""
+    tmp_dir = tempfile.mkdtemp(prefix="footcal-bench-")
+    # The app reads its config from the environment when it's imported, so set it up before importing anything.
+    os.environ.update(
+        DB_URL=args.db_url or f"sqlite:///{tmp_dir}/footcal.db",
+        LOGO_DIR=os.path.join(tmp_dir, "logos"),
+        SCHEDULER_ENABLED="false",
+        QUOTA_PER_MINUTE="1000000",
+        QUOTA_PER_DAY="1000000000",
+    )
+    if args.db_url:
+        _empty_database(args.db_url)
+    import api_stub
+
+    world = api_stub.World()
+    world.load_dump()
+    world.add_synthetic(args.synthetic_comps, args.teams_per_comp)
+    stub = api_stub.Stub(world).start()
+    os.environ.update(APIURL=stub.api_url, LOGO_URL=stub.logo_url)
+
+    import app
+    from werkzeug.serving import make_server
+
+    # Don't log every request.
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    _wait_for_background()
+
+    reqs = _requests(world, route)
+    if scenario == "warm":
+        # Request everything once (without upstream latency) so the data and rendered responses are cached.
+        for other in ROUTES:
+            _load(base_url, _requests(world, other), args.clients, args.accept_encoding)
+        _wait_for_background()
+        reqs = [reqs[i % len(reqs)] for i in range(args.requests)]
+        random.Random(0).shuffle(reqs)
+
+    stub.latency_s = args.upstream_latency_ms / 1000
+    calls_before = dict(stub.calls)
+    samples, elapsed_s = _load(base_url, reqs, args.clients, args.accept_encoding)
+    result = _summarize(samples, elapsed_s)
+    result["upstream_calls"] = {
+        k: v - calls_before.get(k, 0)
+        for k, v in stub.calls.items()
+        if v != calls_before.get(k, 0)
+    }
+    result["world"] = {
+        "calendars": len(world.calendars),
+        "matches": len(world.matches),
+        "searches": len(world.searches),
+    }
+
+    server.shutdown()
+    stub.stop()
+    return result
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _print_results(results: dict) -> None:
+    print(
+        f"{'scenario':<8} {'route':<8} {'reqs':>6} {'errors':>6} {'req/s':>9} {'mean ms':>8} "
+        f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'upstream':>8}"
+    )
+    for scenario, routes in results.items():
+        for route, r in routes.items():
+            lat = r["latency_ms"]
+            print(
+                f"{scenario:<8} {route:<8} {r['requests']:>6} {r['errors']:>6} {r['throughput_rps']:>9.1f} "
+                f"{lat['mean']:>8.2f} {lat['p50']:>8.2f} {lat['p90']:>8.2f} {lat['p99']:>8.2f} "
+                f"{lat['max']:>8.2f} {sum(r['upstream_calls'].values()):>8}"
+            )
+
+
+def _print_comparison(old: dict, new: dict) -> None:
+    def change(before: float, after: float) -> str:
+        return f"{(after - before) / before * 100:+.0f}%" if before else "n/a"
+
+    print(f"\n{'scenario':<8} {'route':<8} {'req/s':>18} {'p50 ms':>22} {'p99 ms':>22}")
+    for scenario, routes in new.items():
+        for route, r in routes.items():
+            before = old.get(scenario, {}).get(route)
+            if before is None:
+                continue
+            cols = []
+            for b, a in (
+                (before["throughput_rps"], r["throughput_rps"]),
+                (before["latency_ms"]["p50"], r["latency_ms"]["p50"]),
+                (before["latency_ms"]["p99"], r["latency_ms"]["p99"]),
+            ):
+                cols.append(f"{b:.1f} -> {a:.1f} ({change(b, a)})")
+            print(f"{scenario:<8} {route:<8} {cols[0]:>18} {cols[1]:>22} {cols[2]:>22}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("--route", choices=ROUTES, action="append")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument(
+        "--requests", type=int, default=500, help="requests per route when warm"
+    )
+    parser.add_argument("--upstream-latency-ms", type=float, default=50)
+    parser.add_argument("--synthetic-comps", type=int, default=0)
+    parser.add_argument("--teams-per-comp", type=int, default=20)
+    parser.add_argument("--accept-encoding", default="gzip")
+    parser.add_argument(
+        "--db-url",
+        help="a throwaway database to use instead of SQLite; it's emptied before each run",
+    )
+    parser.add_argument("--output", default="load_benchmark.json")
+    parser.add_argument("--compare", help="the JSON output of a previous run")
+    # Used to run each scenario and route in its own process.
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_scenario(*args.child, args)
+        with open(args.output, "w") as f:
+            json.dump(result, f)
+        return
+
+    results = {}
+    world = None
+    for scenario in args.scenario or SCENARIOS:
+        for route in args.route or ROUTES:
+            with tempfile.NamedTemporaryFile(suffix=".json") as out:
+                subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        *sys.argv[1:],
+                        "--child",
+                        scenario,
+                        route,
+                        "--output",
+                        out.name,
+                    ],
+                    check=True,
+                )
+                result = json.load(open(out.name))
+            world = result.pop("world")
+            results.setdefault(scenario, {})[route] = result
+
+    output = {
+        "meta": {
+            "created_at": datetime.utcnow().isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k != "child"},
+            "world": world,
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2))
+
+    _print_results(results)
+    print(f"\nsaved to {args.output}")
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text())
+        print(f"compared to {args.compare} (commit {old['meta']['commit']}):")
+        if old["meta"]["world"] != world:
+            print(f"note: that run used different data ({old['meta']['world']})")
+        _print_comparison(old["results"], results)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,34 +2,127 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from bisect import bisect_left
 from datetime import datetime, timedelta
+from hashlib import sha1
 from os import getenv
 from zoneinfo import ZoneInfo
 
 import arrow
+import background
 import cache
+import feeds
+import fixtures
+import homepage
+import ics
+import logos
 import matches
-import requests
+import metrics
+import profiling
+import quota
+import scheduler
 import search
-from custom_types import SearchQuotaExceeded
-from flask import Flask, flash, make_response, render_template, request
-from icalendar import Calendar, Event
+import search_index
+from custom_types import (
+    QuotaExceeded,
+    SearchQuotaExceeded,
+    UpstreamBusy,
+    UpstreamError,
+)
+from flask import (
+    Flask,
+    flash,
+    make_response,
+    render_template,
+    request,
+    send_file,
+)
 from utils import MAP_COUNTRY_TO_EMOJI
+from werkzeug.http import is_resource_modified
+
+# Get the serving config from environment variables.
+config = {
+    # Only for development; the debugger lets whoever sees an error page run code on the server.
+    "debug": getenv("FLASK_DEBUG", "false").lower() in ("1", "true", "yes"),
+    # Set by the production server (see gunicorn.conf.py) when the app is loaded before forking the workers.
+    "preload": getenv("FOOTCAL_PRELOAD", "false").lower() in ("1", "true", "yes"),
+}
 
 app = Flask(__name__)
-app.debug = True
+app.debug = config["debug"]
 app.config["SECRET_KEY"] = getenv("FLASK_SECRET_KEY", "abc")
 
 cache.setupDB(app)
+fixtures.init(app)
+background.init(app)
+quota.init(app)
+logos.init(app)
+# When preloading, build the search index before forking so the workers share it.
+search_index.init(app, wait=config["preload"])
+metrics.init(app)
+profiling.init(app)
+
+
+def start_background_work():
+    """Starts the threads that work outside of the requests."""
+    if scheduler.config["enabled"]:
+        scheduler.start(app)
+
+
+def after_fork():
+    """Gets a worker forked from the preloaded app ready; it can't share the DB connections or threads of its parent."""
+    with app.app_context():
+        cache.db.engine.dispose(close=False)
+    background.after_fork()
+    start_background_work()
+
+
+# When preloading, each worker starts its own after forking.
+if not config["preload"]:
+    start_background_work()
 
 
 @app.route("/", methods=("GET",))
 def index():
-    return render_template(
-        "index.html",
-        active_cals=sorted(cache.list_cached_calendars(), key=lambda x: x.name.lower()),
-        flag_map=MAP_COUNTRY_TO_EMOJI,
+    # The table of active calendars is only rendered again when the list changes.
+    active_rows = homepage.table(
+        request.host_url,
+        lambda active_cals: render_template(
+            "active_cals.html", active_cals=active_cals, flag_map=MAP_COUNTRY_TO_EMOJI
+        ),
     )
+    # Get the logos ready before the browser asks for them.
+    logos.prefetch(homepage.active_calendars())
+    page = render_template("index.html", active_rows=active_rows)
+    encoding = feeds.negotiate(request.accept_encodings)
+    response = make_response(feeds.encode_page(page.encode("utf8"), encoding))
+    _set_encoding(response, encoding)
+    return response
+
+
+def _set_encoding(response, encoding):
+    # The body depends on the request's Accept-Encoding, so caches have to key on it too.
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+
+
+@app.errorhandler(QuotaExceeded)
+def quota_exceeded(e):
+    # We couldn't get data we don't have cached yet; ask the client to come back later.
+    return "Out of API quota, please try again later.", 503, {"Retry-After": "3600"}
+
+
+@app.errorhandler(UpstreamBusy)
+def upstream_busy(e):
+    # Too many requests are waiting for the API already; ask the client to come back soon.
+    return "Too busy, please try again in a few seconds.", 503, {"Retry-After": "10"}
+
+
+@app.errorhandler(UpstreamError)
+def upstream_error(e):
+    # The API failed and we have nothing cached to serve instead.
+    return "Could not get the data, please try again later.", 502, {"Retry-After": "60"}
 
 
 @app.route("/search/", methods=("GET", "POST"))
@@ -43,15 +136,25 @@ def search_ID():
 
         else:
 
-            if team_search:
-                results = search.search_teams(search_query)
+            try:
+                if team_search:
+                    results = search.search_teams(search_query)
 
-            else:
-                results = search.search_comps(search_query)
+                else:
+                    results = search.search_comps(search_query)
+
+            except SearchQuotaExceeded:
+                flash(
+                    "We've run out of searches for now, please try again later or check the calendars on the home page."
+                )
 
-            return render_template(
-                "results.html", query=search_query, team=team_search, results=results
-            )
+            else:
+                return render_template(
+                    "results.html",
+                    query=search_query,
+                    team=team_search,
+                    results=results,
+                )
 
     return render_template("search.html")
 
@@ -61,58 +164,53 @@ def help_page():
     return render_template("help.html")
 
 
-def _create_calendar(team, id):
+def _render_calendar(key, cache_data, version, modified, encoding):
+    # Reuse the ics file rendered (and compressed) for this version of the data if we have one.
+    # The events are stamped with the time the content last changed so the output only changes with it.
+    def build():
+        with metrics.calendar_render_duration.time():
+            return ics.calendar(cache_data, dtstamp=modified)
+
+    return feeds.get_encoded(key, version, "ics", build, encoding)
+
+
+def _calendar_response(team, id):
     # Get the API data from cache.
-    cache_data = matches.fetch(team=team, id=id)
-    # Create calendar with required properties.
-    cal = Calendar()
-    cal.add("PRODID", "-//Footcal//footcal.cbdm.app//EN")
-    cal.add("VERSION", "2.0")
-    cal.add("CALSCALE", "GREGORIAN")
-    cal.add("METHOD", "PUBLISH")
-    cal.add("X-WR-CALNAME", cache_data["info"].name)
-    cal.add("X-WR-TIMEZONE", "UTC")
-    # Add one event for each match.
-    dtstamp = datetime.now(tz=ZoneInfo("UTC"))
-    for m in cache_data["matches"]:
-        e = Event()
-        sep = "-"
-        if m.status in {"FT", "AET", "PEN"}:
-            sep = f"({m.home_score}) - ({m.away_score})"
-        notes = matches.status_map.get(m.status, "")
-
-        start_dt = datetime.fromtimestamp(m.match_utc_ts, tz=ZoneInfo("UTC"))
-        e.add("DTSTART", start_dt)
-        e.add("DTEND", start_dt + timedelta(hours=2))
-        e.add("DTSTAMP", dtstamp)
-        local_uid = f"{start_dt.date()}_{m.league_id}_{m.home_team_id}_{m.away_team_id}"
-        local_uid = local_uid.replace(" ", "_")
-        e.add(
-            "UID",
-            f"{local_uid}@footcal.cbdm.app",
-        )
-        e.add("CREATED", dtstamp)
-        e.add("DESCRIPTION", f"Ref: {m.ref_name}")
-        e.add("LAST-MODIFIED", dtstamp)
-        e.add("LOCATION", f"{m.venue_name}, {m.venue_city}")
-        e.add("SEQUENCE", 0)
-        e.add("STATUS", "CONFIRMED")
-        e.add(
-            "SUMMARY",
-            f"[{m.league_name}] {notes}{m.home_team_name} {sep} {m.away_team_name}",
-        )
-        e.add("TRANSP", "OPAQUE")
-        cal.add_component(e)
-    return cal
+    cache_data, version = matches.fetch_entry(team=team, id=id)
+    key = matches.calendar_key(team, id)
+    scheduler.record_poll(key)
+    encoding = feeds.negotiate(request.accept_encodings)
+
+    # The rendered calendar is fully determined by its content and when that last changed, so we can derive the
+    # validators from them. Each encoding is a different representation, so it gets its own ETag.
+    digest, modified = matches.content_version(key, cache_data, version)
+    etag = sha1(f"{key}@{digest}@{modified.isoformat()}".encode("utf8")).hexdigest()
+    if encoding is not None:
+        etag = f"{etag}-{encoding}"
+    last_modified = modified.replace(tzinfo=ZoneInfo("UTC"), microsecond=0)
+
+    # Answer conditional requests without rendering the calendar if the client's copy is still valid.
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        response = make_response("", 304)
+    else:
+        body = _render_calendar(key, cache_data, version, modified, encoding)
+        metrics.calendar_bytes.observe(len(body), encoding or "identity")
+        response = make_response(body)
+        response.headers["Content-Disposition"] = "attachment; filename=calendar.ics"
+        response.headers["Content-Type"] = "text/calendar; charset=utf-8"
+        _set_encoding(response, encoding)
+
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
 
 
 @app.route("/team/<team_id>/", methods=("GET",))
 def team_cal(team_id):
-    cal = _create_calendar(team=True, id=team_id)
-    response = make_response(f"{cal.to_ical(sorted=False).decode('utf-8')}")
-    response.headers["Content-Disposition"] = "attachment; filename=calendar.ics"
-    response.headers["Content-Type"] = "text/calendar; charset=utf-8"
-    return response
+    return _calendar_response(team=True, id=team_id)
 
 
 @app.route("/team/<team_id>/calendar.ics", methods=("GET",))
@@ -122,11 +220,7 @@ def team_cal_ics(team_id):
 
 @app.route("/comp/<comp_id>/", methods=("GET",))
 def comp_cal(comp_id):
-    cal = _create_calendar(team=False, id=comp_id)
-    response = make_response(f"{cal.to_ical(sorted=False).decode('utf-8')}")
-    response.headers["Content-Disposition"] = "attachment; filename=calendar.ics"
-    response.headers["Content-Type"] = "text/calendar; charset=utf-8"
-    return response
+    return _calendar_response(team=False, id=comp_id)
 
 
 @app.route("/comp/<comp_id>/calendar.ics", methods=("GET",))
@@ -148,18 +242,29 @@ def next_match(type, id):
             "ref": "N/A",
         }
 
-    cal = _create_calendar(team=(type == "team"), id=id)
-    next = None
-    min_diff = timedelta(days=365)
-
-    for e in cal.events:
-        match_end = e.get("DTEND").dt
-        time_diff = match_end - cur_time
-        if time_diff < timedelta(seconds=0):
-            continue
-        if time_diff < min_diff:
-            min_diff = time_diff
-            next = e
+    # Get the API data from cache.
+    team = type == "team"
+    cache_data, version = matches.fetch_entry(team=team, id=id)
+    scheduler.record_poll(matches.calendar_key(team, id))
+
+    # Find the first match that hasn't ended yet using the matches sorted by kickoff time.
+    kickoffs, sorted_matches = feeds.get(
+        matches.calendar_key(team, id),
+        version,
+        "kickoff-index",
+        lambda: matches.kickoff_index(cache_data["matches"]),
+    )
+    cur_ts = cur_time.timestamp()
+    i = bisect_left(kickoffs, cur_ts - ics.MATCH_DURATION.total_seconds())
+    next = sorted_matches[i] if i < len(sorted_matches) else None
+
+    # Only consider matches that end within a year.
+    if (
+        next is not None
+        and next.match_utc_ts + ics.MATCH_DURATION.total_seconds() - cur_ts
+        >= timedelta(days=365).total_seconds()
+    ):
+        next = None
 
     if next is None:
         return {
@@ -171,48 +276,47 @@ def next_match(type, id):
             "ref": "N/A",
         }
 
-    brace_index = next.get("summary").index("]")
-    competition = next.get("summary")[1:brace_index]
-    teams = next.get("summary")[brace_index + 2 :]
-    venue = next.get("location")
-    ref = next.get("description")
-    ref = ref[len("Ref: ") :]
+    start_dt = datetime.fromtimestamp(next.match_utc_ts, tz=ZoneInfo("UTC"))
 
     return {
-        "teams": teams,
-        "competition": competition,
-        "start_time": f"{next.get('dtstart').dt.isoformat()}",
-        "venue": venue,
-        "ref": ref,
+        "teams": ics.match_teams(next),
+        "competition": next.league_name,
+        "start_time": f"{start_dt.isoformat()}",
+        "venue": f"{next.venue_name}, {next.venue_city}",
+        "ref": f"{next.ref_name}",
         "extra_info": "N/A",
     }
 
 
 @app.route("/logo/<type>/<id>/", methods=("GET",))
 def get_logo(type, id):
-    # Check if the logo is cached.
-    cache_key = f"logo/{type}/{id}"
-    logo, unused_is_fresh = cache.query(cache_key, max_age=timedelta(weeks=104))
-    if not logo:
-        # If it is not cached yet, request the logo from the API.
-        logo_base_url = "https://media.api-sports.io/football/{type}/{id}.png"
-        new_logo_url = logo_base_url.format(
-            id=id, type="teams" if type == "team" else "leagues"
-        )
-        resp = requests.get(new_logo_url, timeout=10)
-
-        # If the request wasn't successful, return the same response.
-        if resp.status_code != 200:
-            return resp.content, resp.status_code, resp.headers.items()
+    if type not in ("team", "comp"):
+        return "", 404
+
+    # Get the logo from the store, downloading it if needed.
+    digest = logos.get(type, id)
+    if digest is None:
+        return "", 404
+
+    # Logos (almost) never change, so browsers can keep them for a long time.
+    response = send_file(
+        logos.file_path(digest),
+        mimetype="image/png",
+        etag=digest,
+        max_age=logos.config["browser_max_age_s"],
+    )
+    response.cache_control.immutable = True
+    return response
 
-        # If the request was succesful, cache the logo received.
-        logo = resp.content
-        cache.update(cache_key, logo)
 
-    # Respond with the logo.
-    return logo, 200, {"Content-Type": "image/png", "Content-Length": len(logo)}
+@app.route("/metrics", methods=("GET",))
+def get_metrics():
+    if not metrics.authorized(request.headers.get("Authorization", "")):
+        return "", 403
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 
 if __name__ == "__main__":
+    # Development server; see gunicorn.conf.py for production.
     # Threaded option to enable multiple instances for multiple user access support
     app.run(threaded=True, port=5000)
@@ -0,0 +1,63 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from threading import Lock
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+def _create_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=int(getenv("BACKGROUND_WORKERS", "4")),
+        thread_name_prefix="footcal-background",
+    )
+
+
+# Workers used to refresh cache entries outside of the requests.
+_executor = _create_executor()
+
+# The flask app, so the jobs can use the DB; assigned in the init method.
+_app = None
+
+# Keys of the jobs that are queued or running.
+_pending: set[str] = set()
+_lock = Lock()
+
+
+def init(app) -> None:
+    global _app
+    _app = app
+
+
+def after_fork() -> None:
+    """Replaces the workers in a forked process, since threads don't survive a fork; queued jobs are dropped."""
+    global _executor
+    _executor = _create_executor()
+    with _lock:
+        _pending.clear()
+
+
+def submit(key: str, job: Callable[[], object]) -> bool:
+    """Runs the job in the background unless there's already one queued for the same key.
+
+    Returns whether the job was queued.
+    """
+    with _lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+
+    _executor.submit(_run, key, job)
+    return True
+
+
+def _run(key: str, job: Callable[[], object]) -> None:
+    try:
+        with _app.app_context():
+            job()
+    except Exception:
+        logger.exception(f"background job for {key} failed")
+    finally:
+        with _lock:
+            _pending.discard(key)
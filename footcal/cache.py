@@ -1,12 +1,37 @@
+import json
+import logging
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import fields
 from datetime import datetime, timedelta
 from os import getenv
-from typing import Any, List
-from custom_types import ActiveCalendar
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Iterator, List, Optional
+from uuid import uuid4
+
+import metrics
+from custom_types import ActiveCalendar, Competition, Match, Team
+from flask import has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from jsonpickle import dumps, loads
 from pymysql import install_as_MySQLdb
+from sqlalchemy import (
+    Column,
+    DateTime,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    text,
+)
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import select
 
+logger = logging.getLogger(__name__)
+
 # Setup the mysql driver.
 install_as_MySQLdb()
 
@@ -14,6 +39,21 @@ install_as_MySQLdb()
 db = None
 table = None
 
+# Locks shared by every process using the DB (see `lock`), by cache key.
+_locks_metadata = MetaData()
+locks_table = Table(
+    "cache_locks",
+    _locks_metadata,
+    Column("objkey", String(200), primary_key=True),
+    Column("owner", String(32), nullable=False),
+    Column("expires_at", DateTime, nullable=False),
+)
+# How often we check if a lock held by someone else was released.
+LOCK_POLL_S = 0.2
+
+# Functions that are called with the key of every entry that gets updated.
+update_listeners: List[Callable[[str], None]] = []
+
 # Get db config from environment variables.
 # Default values should work with the 'testdb' in the repo.
 db_config = {
@@ -22,88 +62,446 @@ db_config = {
     "user": getenv("DB_USER", "root"),
     "passwd": getenv("DB_PASS", "root"),
     "database": getenv("DB_NAME", "footcal-db"),
+    # Any SQLAlchemy database URL, used instead of the settings above (e.g., "sqlite:///footcal.db" as a local stand-in).
+    "url": getenv("DB_URL"),
+}
+
+# Name of the codec used to write new entries; see `codecs` below.
+codec_config = {
+    "write": getenv("CACHE_CODEC", "compact"),
 }
 
+# Config for the in-process (L1) cache that sits in front of the DB.
+# Entries are only kept for a short time so that updates made by other processes are picked up.
+l1_config = {
+    "enabled": getenv("CACHE_L1_ENABLED", "true").lower() in ("1", "true", "yes"),
+    "max_entries": int(getenv("CACHE_L1_MAX_ENTRIES", "512")),
+    "ttl_s": float(getenv("CACHE_L1_TTL_S", "60")),
+}
+
+# Maps the cache key to a tuple with the decoded value, its timestamp, and when it was loaded into L1.
+# Note that the values are shared between callers, so they should not be modified.
+_l1: OrderedDict[str, tuple[Any, datetime, float]] = OrderedDict()
+_l1_lock = Lock()
+l1_stats = {"hits": 0, "misses": 0, "evictions": 0}
+metrics.Exposed(
+    "footcal_cache_l1_events_total",
+    "Hits, misses, and evictions of the in-process cache.",
+    "counter",
+    ("event",),
+    lambda: [((event,), count) for event, count in l1_stats.items()],
+)
+metrics.Exposed(
+    "footcal_cache_l1_entries",
+    "Entries in the in-process cache.",
+    "gauge",
+    (),
+    lambda: [((), len(_l1))],
+)
+
+
+def _l1_get(key: str) -> Optional[tuple[Any, datetime]]:
+    if not l1_config["enabled"]:
+        return None
+
+    with _l1_lock:
+        entry = _l1.get(key)
+        if entry is None or entry[2] + l1_config["ttl_s"] < monotonic():
+            l1_stats["misses"] += 1
+            return None
+
+        _l1.move_to_end(key)
+        l1_stats["hits"] += 1
+        return entry[0], entry[1]
+
+
+def _l1_put(key: str, value: Any, ts: datetime) -> None:
+    if not l1_config["enabled"]:
+        return
+
+    with _l1_lock:
+        _l1[key] = (value, ts, monotonic())
+        _l1.move_to_end(key)
+        while len(_l1) > l1_config["max_entries"]:
+            _l1.popitem(last=False)
+            l1_stats["evictions"] += 1
+
+
+def l1_clear() -> None:
+    """Drops every entry from the in-process cache."""
+    with _l1_lock:
+        _l1.clear()
+
+
+class JsonPickleCodec:
+    """Legacy format: a jsonpickle'd dict with the value and its timestamp."""
+
+    name = "jsonpickle"
+
+    def encode(self, value: Any, ts: datetime) -> bytes:
+        return dumps({"value": value, "ts": ts}).encode("utf8")
+
+    def decode(self, raw: bytes) -> tuple[Any, datetime]:
+        data = loads(raw)
+        return data["value"], data["ts"]
+
+
+class CompactCodec:
+    """Schema-aware format: a JSON array with the format version, the timestamp, and the value.
+
+    Our dataclasses are stored as positional rows tagged by their type, so the field names and
+    python paths are not repeated for every match. Lists of the same dataclass share a single tag.
+    The entries are still valid JSON because that's what the `cached_data` column accepts.
+    """
+
+    name = "compact"
+    # Entries written with other versions of the format are rejected.
+    version = 1
+
+    # Tags used for the dataclasses; the rows follow each class' field order.
+    # Adding fields at the end is safe (older rows will use the defaults, and rows with more fields than we know
+    # were written by a newer version so they are rejected); any other change needs a new version.
+    types = {"M": Match, "T": Team, "C": Competition}
+    tags = {cls: tag for tag, cls in types.items()}
+    columns = {cls: [f.name for f in fields(cls)] for cls in types.values()}
+
+    def _row(self, obj: Any) -> list:
+        return [getattr(obj, c) for c in self.columns[type(obj)]]
+
+    def _pack(self, obj: Any) -> Any:
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        if isinstance(obj, bytes):
+            return {"$b": b64encode(obj).decode("ascii")}
+        if type(obj) in self.tags:
+            return {f"${self.tags[type(obj)]}": self._row(obj)}
+        if isinstance(obj, (list, tuple)):
+            cls = type(obj[0]) if obj else None
+            if cls in self.tags and all(type(o) is cls for o in obj):
+                return {f"${self.tags[cls]}*": [self._row(o) for o in obj]}
+            return [self._pack(o) for o in obj]
+        if isinstance(obj, dict):
+            if any(not isinstance(k, str) or k.startswith("$") for k in obj):
+                raise TypeError(f"cannot encode dict keys {list(obj)}")
+            return {k: self._pack(v) for k, v in obj.items()}
+        raise TypeError(f"cannot encode values of type {type(obj)}")
+
+    def _unpack(self, obj: Any) -> Any:
+        if isinstance(obj, list):
+            return [self._unpack(o) for o in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if len(obj) == 1:
+            ((k, v),) = obj.items()
+            if k == "$b":
+                return b64decode(v)
+            if k.startswith("$"):
+                cls = self.types.get(k[1:].rstrip("*"))
+                if cls is None:
+                    raise ValueError(f"unknown type tag {k}")
+                rows = v if k.endswith("*") else [v]
+                if any(len(row) > len(self.columns[cls]) for row in rows):
+                    raise ValueError(f"{cls.__name__} rows with unknown fields")
+                objs = [cls(*row) for row in rows]
+                return objs if k.endswith("*") else objs[0]
+        return {k: self._unpack(v) for k, v in obj.items()}
+
+    def encode(self, value: Any, ts: datetime) -> bytes:
+        ts_us = (ts - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+        return json.dumps(
+            [self.version, ts_us, self._pack(value)],
+            separators=(",", ":"),
+            ensure_ascii=False,
+        ).encode("utf8")
+
+    def decode(self, raw: bytes) -> tuple[Any, datetime]:
+        version, ts_us, value = json.loads(raw)
+        if version != self.version:
+            raise ValueError(f"unsupported {self.name} format version {version}")
+        return self._unpack(value), datetime(1970, 1, 1) + timedelta(microseconds=ts_us)
+
+
+# Available codecs, by name.
+codecs = {c.name: c for c in (JsonPickleCodec(), CompactCodec())}
+
+
+def encode(value: Any, ts: datetime) -> bytes:
+    """Serializes the value and its timestamp using the configured codec."""
+    return codecs[codec_config["write"]].encode(value, ts)
+
+
+def decode(raw: bytes) -> tuple[Any, datetime]:
+    """Deserializes an entry written by any of the codecs.
+
+    Raises ValueError if the entry can't be read (e.g., it was written by a newer version of the format).
+    """
+    # Legacy entries are json objects, while versioned ones are json arrays starting with their version.
+    if raw.lstrip()[:1] in (b"{", "{"):
+        return codecs["jsonpickle"].decode(raw)
+    return codecs["compact"].decode(raw)
+
+
+def unicode_string(length: int):
+    # The legacy table defaults to latin1, so make sure text columns can hold any team name.
+    return String(length).with_variant(
+        mysql.VARCHAR(length, charset="utf8mb4"), "mysql"
+    )
+
 
 def setupDB(app):
     global db
     global table
 
     # Setup the connection between app and DB.
-    app.config["SQLALCHEMY_DATABASE_URI"] = (
-        "mysql://{user}:{passwd}@{host}:{port}/{database}".format(**db_config)
+    url = db_config["url"] or "mysql://{user}:{passwd}@{host}:{port}/{database}".format(
+        **db_config
     )
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db = SQLAlchemy(app)
+    with app.app_context():
+        metrics.instrument_engine(db.engine)
 
     # Configure the DB table.
     class CachedData(db.Model):
         objkey = db.Column(db.String(200), primary_key=True)
         data = db.Column(db.LargeBinary)
+        # Metadata filled in by `update` so we can list entries without decoding them.
+        kind = db.Column(db.String(20), index=True)
+        # The rest of the key after the kind, so it can be as long as the key.
+        entity_id = db.Column(db.String(200))
+        name = db.Column(unicode_string(200))
+        country = db.Column(unicode_string(100))
+        updated_at = db.Column(db.DateTime, index=True)
 
         def __repr__(self):
             return f"<CachedData {self.objkey}>"
 
     table = CachedData
 
+    with app.app_context():
+        migrate()
 
-def query(key: str, max_age: timedelta) -> tuple[Any, bool]:
-    """Returns a tuple with the stored value if any and a boolean indicating if the data is fresh."""
-    record = table.query.get(key)
-    if not record:
-        return None, False
 
-    data = loads(record.data) if record else None
-    if data is None:
-        return None, False
+def migrate() -> None:
+    """Creates or upgrades the cache schema and backfills the metadata of older entries."""
+    db.create_all()
+    _locks_metadata.create_all(db.engine)
+
+    # Add the columns and indexes that are missing from tables created by older versions, and widen the columns
+    # they created shorter (SQLite doesn't enforce lengths).
+    inspector = inspect(db.engine)
+    existing = {c["name"]: c for c in inspector.get_columns(table.__tablename__)}
+    with db.engine.begin() as conn:
+        for column in table.__table__.columns:
+            col_type = column.type.compile(dialect=db.engine.dialect)
+            if column.name not in existing:
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.__tablename__} ADD COLUMN {column.name} {col_type}"
+                    )
+                )
+            elif db.engine.dialect.name == "mysql" and (
+                getattr(existing[column.name]["type"], "length", None) or 0
+            ) < (getattr(column.type, "length", None) or 0):
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.__tablename__} MODIFY COLUMN {column.name} {col_type}"
+                    )
+                )
+    for index in table.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
+    # Backfill the metadata for the entries written before the columns existed.
+    missing = select(table.objkey).where(table.kind.is_(None))
+    for (key,) in db.session.execute(missing).all():
+        record = db.session.get(table, key)
+        value, ts = decode(record.data)
+        for attr, val in _metadata(key, value, ts).items():
+            setattr(record, attr, val)
+        db.session.commit()
+
+
+def active_calendar(key: str, value: Any) -> Optional[ActiveCalendar]:
+    """Returns how the entry is listed among the active calendars, or None if it's not a calendar."""
+    kind, _, entity_id = key.partition("/")
+    if kind not in ("team-cal", "comp-cal") or not value:
+        return None
+    is_team = kind == "team-cal"
+    info = value["info"]
+    return ActiveCalendar(
+        id=entity_id,
+        is_team=is_team,
+        name=info.name,
+        country=info.country if is_team else info.country_name,
+    )
+
+
+def _metadata(key: str, value: Any, ts: datetime) -> dict[str, Any]:
+    """Extracts the metadata columns for the given entry."""
+    kind, _, entity_id = key.partition("/")
+    cal = active_calendar(key, value)
+    return {
+        "kind": kind,
+        "entity_id": entity_id,
+        "name": cal.name if cal else None,
+        "country": cal.country if cal else None,
+        "updated_at": ts,
+    }
+
+
+def _lookup(key: str, use_l1: bool) -> Optional[tuple[Any, datetime]]:
+    entry = _l1_get(key) if use_l1 else None
+    if entry is None:
+        record = table.query.get(key)
+        if not record:
+            return None
+
+        try:
+            entry = decode(record.data)
+        except ValueError:
+            # Treat it as missing; the refresh will replace it with an entry we can read.
+            logger.warning(
+                f"could not decode the cached entry for {key}", exc_info=True
+            )
+            return None
+        _l1_put(key, *entry)
+    return entry
+
+
+def release_connection() -> None:
+    """Gives the session's DB connection back to the pool, e.g., before waiting for the API."""
+    # The connection is otherwise kept until the end of the request, so requests waiting for the API could
+    # take every connection in the pool.
+    if has_app_context():
+        db.session.close()
+
+
+def query_entry(
+    key: str, max_age: timedelta, use_l1: bool = True, record: bool = True
+) -> tuple[Any, bool, Optional[datetime]]:
+    """Same as `query`, but also returns when the value was stored (or None if there's no value).
+
+    Pass `record=False` for lookups that don't serve a request (e.g., re-reads and the scheduler's) so they
+    aren't counted in the metrics.
+    """
+    entry = _lookup(key, use_l1)
+    kind = key.partition("/")[0]
+    if entry is None:
+        if record:
+            metrics.cache_lookups.inc(kind, "miss")
+        return None, False, None
+
+    value, ts = entry
+    fresh = ts + max_age >= datetime.utcnow()
+    if record:
+        metrics.cache_lookups.inc(kind, "hit" if fresh else "stale")
+    return value, fresh, ts
+
+
+def latest(key: str) -> tuple[Any, Optional[datetime]]:
+    """Returns the stored value and its timestamp (or None, None), e.g., for an entry that was just updated."""
+    entry = _lookup(key, use_l1=True)
+    return entry if entry is not None else (None, None)
+
 
-    return data["value"], data["ts"] + max_age >= datetime.utcnow()
+def query(key: str, max_age: timedelta) -> tuple[Any, bool]:
+    """Returns a tuple with the stored value if any and a boolean indicating if the data is fresh."""
+    value, is_fresh, unused_ts = query_entry(key, max_age)
+    return value, is_fresh
 
 
-def update(key: str, new_val: Any) -> None:
+def update(key: str, new_val: Any) -> datetime:
+    """Stores the new value for the given key and returns the timestamp recorded with it."""
+    ts = datetime.utcnow()
     record = table.query.get(key)
     if record:
-        record.data = dumps({"value": new_val, "ts": datetime.utcnow()}).encode("utf8")
+        record.data = encode(new_val, ts)
 
     else:
-        record = table(
-            objkey=key,
-            data=dumps({"value": new_val, "ts": datetime.utcnow()}).encode("utf8"),
-        )
+        record = table(objkey=key, data=encode(new_val, ts))
+
+    for attr, val in _metadata(key, new_val, ts).items():
+        setattr(record, attr, val)
 
     db.session.add(record)
     db.session.commit()
+    _l1_put(key, new_val, ts)
 
+    for listener in update_listeners:
+        listener(key)
 
-def list_cached_calendars(team: bool = None) -> List[ActiveCalendar]:
-    cached_cals = []
-    for result in db.session.execute(select(table)):
-        entry = result[0]
-
-        # Ignore entries that are not calendars (e.g., searches).
-        # TODO: could add a new column and filter these with the select query above.
-        if not (
-            entry.objkey.startswith("team-cal") or entry.objkey.startswith("comp-cal")
-        ):
-            continue
-
-        # Filter the calendar list, if wanted.
-        if team is not None and not (
-            (team and entry.objkey.startswith("team-cal"))
-            or (not team and entry.objkey.startswith("comp-cal"))
-        ):
-            continue
-
-        cal_id = entry.objkey[len(f"{'team' if team else 'comp'}-cal/") :]
-        calendar = loads(entry.data)["value"]
-        name = calendar["info"].name
-        is_team = entry.objkey.startswith("team-cal")
-        country = calendar["info"].country if is_team else calendar["info"].country_name
-        cached_cals.append(
-            ActiveCalendar(id=cal_id, is_team=is_team, name=name, country=country)
+    return ts
+
+
+def _try_lock(key: str, owner: str, hold_s: float) -> bool:
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=hold_s)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(
+                locks_table.insert().values(
+                    objkey=key, owner=owner, expires_at=expires_at
+                )
+            )
+        return True
+    except IntegrityError:
+        pass
+
+    # Someone else has it; take it over if they didn't release it in time (e.g., their process died).
+    with db.engine.begin() as conn:
+        taken = conn.execute(
+            locks_table.update()
+            .where(locks_table.c.objkey == key, locks_table.c.expires_at < now)
+            .values(owner=owner, expires_at=expires_at)
         )
+    return taken.rowcount == 1
 
-    return cached_cals
+
+@contextmanager
+def lock(key: str, wait_s: float, hold_s: float) -> Iterator[bool]:
+    """Holds a lock on the given key that is shared by every process using the DB.
+
+    Waits up to `wait_s` seconds to get it and yields whether it was acquired.
+    The lock is a row in the DB rather than a connection, so no connection is held while the lock is; it expires
+    after `hold_s` seconds in case we never release it.
+    """
+    owner = uuid4().hex
+    deadline = monotonic() + wait_s
+    acquired = _try_lock(key, owner, hold_s)
+    while not acquired and monotonic() < deadline:
+        sleep(LOCK_POLL_S)
+        acquired = _try_lock(key, owner, hold_s)
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    locks_table.delete().where(
+                        locks_table.c.objkey == key, locks_table.c.owner == owner
+                    )
+                )
+
+
+def list_cached_calendars(team: bool = None) -> List[ActiveCalendar]:
+    # Filter the calendar list, if wanted.
+    if team is None:
+        kinds = ("team-cal", "comp-cal")
+    else:
+        kinds = ("team-cal",) if team else ("comp-cal",)
+
+    # Only read the metadata columns so we never have to decode the cached calendars.
+    stmt = select(table.kind, table.entity_id, table.name, table.country).where(
+        table.kind.in_(kinds)
+    )
+    return [
+        ActiveCalendar(
+            id=entity_id, is_team=(kind == "team-cal"), name=name, country=country
+        )
+        for kind, entity_id, name, country in db.session.execute(stmt)
+    ]
 
 
 if __name__ == "__main__":
@@ -18,6 +18,7 @@ class Match:
     status: str
     home_score: int = None
     away_score: int = None
+    season: int = None
 
 
 @dataclass
@@ -44,6 +45,14 @@ class Competition:
     logo: str
 
 
+@dataclass
+class FixtureWindow:
+    league_id: int
+    season: int
+    start_ts: int
+    end_ts: int
+
+
 @dataclass
 class ActiveCalendar:
     id: int
@@ -52,7 +61,25 @@ class ActiveCalendar:
     country: str
 
 
-class SearchQuotaExceeded(Exception):
+class QuotaExceeded(Exception):
+    "Raised when there is no more available quota for API requests."
+
+    pass
+
+
+class SearchQuotaExceeded(QuotaExceeded):
     "Raised when there is no more available quota for search requests."
 
     pass
+
+
+class UpstreamBusy(Exception):
+    "Raised when too many refreshes are already waiting for the API."
+
+    pass
+
+
+class UpstreamError(Exception):
+    "Raised when the API could not answer a request (e.g., it sent an error instead of the data)."
+
+    pass
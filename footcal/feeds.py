@@ -0,0 +1,117 @@
+import gzip
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+from os import getenv
+from threading import Lock
+from typing import Any, Callable, Optional
+
+import cache
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is in the requirements, but we can still serve gzip if it fails to install (e.g., no wheels).
+    brotli = None
+
+# The content encodings we can serve, in order of preference, and how to produce them.
+# Compressed artifacts are produced once per version, so we can afford the best compression levels.
+ENCODERS: dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=11)
+ENCODERS["gzip"] = lambda body: gzip.compress(body, compresslevel=9, mtime=0)
+
+# Get the config of the artifacts kept in memory from environment variables.
+artifact_config = {
+    # How many calendars we keep the artifacts of; the least recently used ones are dropped first.
+    "max_entries": int(getenv("FEEDS_ARTIFACTS_MAX_ENTRIES", "2000")),
+}
+
+# Artifacts derived from the cached calendars (e.g., the rendered ics file).
+# Maps the calendar's cache key to a tuple with the version (i.e., cache timestamp) of the data
+# that was used to build the artifacts, and a dict with the artifacts built from that version.
+_artifacts: OrderedDict[str, tuple[datetime, dict[str, Any]]] = OrderedDict()
+_lock = Lock()
+
+
+def get(key: str, version: datetime, name: str, build: Callable[[], Any]) -> Any:
+    """Returns the artifact with the given name for this version of the calendar, building it if needed."""
+    with _lock:
+        entry = _artifacts.get(key)
+        if entry is not None and entry[0] == version and name in entry[1]:
+            _artifacts.move_to_end(key)
+            return entry[1][name]
+
+    artifact = build()
+
+    with _lock:
+        entry = _artifacts.get(key)
+        # Only keep artifacts for the most recent version that we know of.
+        if entry is None or entry[0] < version:
+            entry = (version, {})
+            _artifacts[key] = entry
+        if entry[0] == version:
+            entry[1][name] = artifact
+            _artifacts.move_to_end(key)
+            while len(_artifacts) > artifact_config["max_entries"]:
+                _artifacts.popitem(last=False)
+
+    return artifact
+
+
+def negotiate(accept_encodings) -> Optional[str]:
+    """Picks the encoding to respond with from the request's Accept-Encoding, or None to send it as is."""
+    return accept_encodings.best_match(list(ENCODERS))
+
+
+def get_encoded(
+    key: str,
+    version: datetime,
+    name: str,
+    build: Callable[[], bytes],
+    encoding: Optional[str],
+) -> bytes:
+    """Same as `get`, but returns the artifact compressed with the given encoding (see `negotiate`)."""
+    if encoding is None:
+        return get(key, version, name, build)
+    return get(
+        key,
+        version,
+        f"{name}:{encoding}",
+        lambda: ENCODERS[encoding](get(key, version, name, build)),
+    )
+
+
+# Pages that aren't versioned (e.g., with flashed messages) are compressed for each distinct body instead.
+# Maps the body's digest and the encoding to the compressed body, for the last few bodies.
+_MAX_PAGES = 32
+_pages: OrderedDict[tuple[bytes, str], bytes] = OrderedDict()
+
+
+def encode_page(body: bytes, encoding: Optional[str]) -> bytes:
+    """Compresses the body with the given encoding, reusing the result if we've seen the same body recently."""
+    if encoding is None:
+        return body
+    page_key = (sha1(body).digest(), encoding)
+    with _lock:
+        encoded = _pages.get(page_key)
+        if encoded is not None:
+            _pages.move_to_end(page_key)
+            return encoded
+
+    encoded = ENCODERS[encoding](body)
+    with _lock:
+        _pages[page_key] = encoded
+        while len(_pages) > _MAX_PAGES:
+            _pages.popitem(last=False)
+    return encoded
+
+
+def invalidate(key: str) -> None:
+    """Drops all artifacts built for the given calendar."""
+    with _lock:
+        _artifacts.pop(key, None)
+
+
+# Drop the rendered calendars as soon as new data is written for them.
+cache.update_listeners.append(invalidate)
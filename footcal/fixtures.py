@@ -0,0 +1,197 @@
+from dataclasses import asdict, fields
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+import cache
+from custom_types import FixtureWindow, Match
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    and_,
+    or_,
+    select,
+)
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+# Every fixture we've seen is stored once, by id, and calendars only list the ids of their fixtures.
+# This lets a single request for a competition's fixtures serve the calendars of all its teams, and
+# updating a fixture doesn't require rewriting every calendar that has it.
+_metadata = MetaData()
+fixtures_table = Table(
+    "fixtures",
+    _metadata,
+    Column("id", BigInteger, primary_key=True, autoincrement=False),
+    Column("ref_name", cache.unicode_string(100)),
+    Column("match_utc_ts", BigInteger, nullable=False, index=True),
+    Column("venue_id", Integer),
+    Column("venue_name", cache.unicode_string(200)),
+    Column("venue_city", cache.unicode_string(100)),
+    Column("league_id", Integer, nullable=False),
+    Column("league_name", cache.unicode_string(200)),
+    Column("home_team_id", Integer, nullable=False, index=True),
+    Column("away_team_id", Integer, nullable=False, index=True),
+    Column("home_team_name", cache.unicode_string(200)),
+    Column("away_team_name", cache.unicode_string(200)),
+    Column("status", String(10)),
+    Column("home_score", Integer),
+    Column("away_score", Integer),
+    Column("season", Integer),
+    Column("updated_at", DateTime, nullable=False),
+    Index("ix_fixtures_league_ts", "league_id", "match_utc_ts"),
+)
+# Which fixtures are in each calendar, by the calendar's cache key.
+memberships_table = Table(
+    "calendar_fixtures",
+    _metadata,
+    Column("objkey", String(200), primary_key=True),
+    Column("fixture_id", BigInteger, primary_key=True, index=True),
+)
+
+_MATCH_FIELDS = [f.name for f in fields(Match)]
+
+
+def init(app) -> None:
+    """Creates the fixture tables if they don't exist."""
+    with app.app_context():
+        _metadata.create_all(cache.db.engine)
+
+
+def _to_match(row) -> Match:
+    return Match(**{name: row._mapping[name] for name in _MATCH_FIELDS})
+
+
+def _upsert(conn, matches: List[Match]) -> None:
+    if not matches:
+        return
+    now = datetime.utcnow()
+    # Fixtures can show up more than once (e.g., in the next and last matches of a team).
+    rows = list({m.id: dict(asdict(m), updated_at=now) for m in matches}.values())
+    columns = [c for c in rows[0] if c != "id"]
+
+    dialect = conn.dialect.name
+    if dialect == "mysql":
+        stmt = mysql.insert(fixtures_table).values(rows)
+        stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in columns})
+    elif dialect in ("sqlite", "postgresql"):
+        module = sqlite if dialect == "sqlite" else postgresql
+        stmt = module.insert(fixtures_table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"], set_={c: stmt.excluded[c] for c in columns}
+        )
+    else:
+        for row in rows:
+            updated = conn.execute(
+                fixtures_table.update()
+                .where(fixtures_table.c.id == row["id"])
+                .values(**row)
+            )
+            if updated.rowcount == 0:
+                conn.execute(fixtures_table.insert().values(**row))
+        return
+    conn.execute(stmt)
+
+
+def upsert(matches: Iterable[Match]) -> None:
+    """Adds or updates the given fixtures."""
+    with cache.db.engine.begin() as conn:
+        _upsert(conn, list(matches))
+
+
+def updated_since(ids: Iterable[int], since: datetime) -> dict[int, Match]:
+    """Returns the given fixtures that were updated after `since`, by id."""
+    ids = list(ids)
+    if not ids:
+        return {}
+    stmt = select(fixtures_table).where(
+        fixtures_table.c.id.in_(ids), fixtures_table.c.updated_at > since
+    )
+    with cache.db.engine.connect() as conn:
+        return {row.id: _to_match(row) for row in conn.execute(stmt)}
+
+
+def moved_from_window(window: FixtureWindow, keep: Iterable[int]) -> List[int]:
+    """Returns the ids of the stored fixtures within the window that aren't in `keep` (e.g., rescheduled)."""
+    keep = set(keep)
+    # An empty window is more likely a bad response than every match being moved, so don't report any.
+    if not keep:
+        return []
+    stmt = select(fixtures_table.c.id).where(
+        fixtures_table.c.league_id == window.league_id,
+        fixtures_table.c.match_utc_ts >= window.start_ts,
+        fixtures_table.c.match_utc_ts < window.end_ts,
+        fixtures_table.c.id.not_in(keep),
+    )
+    with cache.db.engine.connect() as conn:
+        return list(conn.execute(stmt).scalars())
+
+
+def save_calendar(key: str, matches: Iterable[Match]) -> None:
+    """Stores the calendar's fixtures and makes them the only fixtures in the calendar."""
+    matches = list(matches)
+    ids = {m.id for m in matches}
+    with cache.db.engine.begin() as conn:
+        _upsert(conn, matches)
+        conn.execute(
+            memberships_table.delete().where(
+                memberships_table.c.objkey == key,
+                memberships_table.c.fixture_id.not_in(ids),
+            )
+        )
+        existing = set(
+            conn.execute(
+                select(memberships_table.c.fixture_id).where(
+                    memberships_table.c.objkey == key
+                )
+            ).scalars()
+        )
+        if ids - existing:
+            conn.execute(
+                memberships_table.insert(),
+                [{"objkey": key, "fixture_id": i} for i in ids - existing],
+            )
+
+
+def calendar_matches(key: str) -> tuple[List[Match], Optional[datetime]]:
+    """Returns the fixtures in the calendar, sorted by kickoff time, and when the last of them was updated.
+
+    The fixtures are shared with other calendars, so they can change without the calendar being stored again.
+    """
+    stmt = (
+        select(fixtures_table)
+        .join(
+            memberships_table,
+            and_(
+                memberships_table.c.fixture_id == fixtures_table.c.id,
+                memberships_table.c.objkey == key,
+            ),
+        )
+        .order_by(fixtures_table.c.match_utc_ts)
+    )
+    with cache.db.engine.connect() as conn:
+        rows = conn.execute(stmt).all()
+    return [_to_match(row) for row in rows], max(
+        (row.updated_at for row in rows), default=None
+    )
+
+
+def team_matches(team_id: int, league_ids: Iterable[int]) -> List[Match]:
+    """Returns the team's fixtures in the given competitions, sorted by kickoff time."""
+    stmt = (
+        select(fixtures_table)
+        .where(
+            or_(
+                fixtures_table.c.home_team_id == team_id,
+                fixtures_table.c.away_team_id == team_id,
+            ),
+            fixtures_table.c.league_id.in_(list(league_ids)),
+        )
+        .order_by(fixtures_table.c.match_utc_ts)
+    )
+    with cache.db.engine.connect() as conn:
+        return [_to_match(row) for row in conn.execute(stmt)]
@@ -0,0 +1,38 @@
+import os
+from os import getenv
+
+# Production server config; run it with `gunicorn -c footcal/gunicorn.conf.py`.
+# By default the workers are gevent workers: requests waiting for the API (or the DB) yield to the others
+# instead of holding a thread, so a burst of cache misses doesn't hold up the cached calendars.
+worker_class = getenv("GUNICORN_WORKER_CLASS", "gevent")
+if worker_class == "gevent":
+    # Patch the standard library before the app (and requests) is imported, since it's loaded before forking.
+    from gevent import monkey
+
+    monkey.patch_all()
+
+# The app's modules import each other by name, so run from their folder.
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = "wsgi:app"
+bind = getenv("GUNICORN_BIND", f"0.0.0.0:{getenv('PORT', '8000')}")
+workers = int(getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# How many requests each gevent worker handles at a time; the refreshes that wait for the API are limited by
+# REFRESH_MAX_CONCURRENT.
+worker_connections = int(getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+# Only used by the (non-gevent) gthread workers.
+threads = int(getenv("GUNICORN_THREADS", "8"))
+# Longer than a request can wait for the API.
+timeout = int(getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+# Load the app (and build its search index) once, before forking the workers.
+preload_app = True
+os.environ["FOOTCAL_PRELOAD"] = "true"
+
+
+def post_fork(server, worker):
+    import app
+
+    app.after_fork()
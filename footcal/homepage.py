@@ -0,0 +1,97 @@
+from bisect import insort
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Callable, List
+
+import cache
+from custom_types import ActiveCalendar
+from markupsafe import Markup
+
+# Get the homepage config from environment variables.
+config = {
+    # Calendars created by other processes are picked up when the list is reloaded from the DB.
+    "reload_s": float(getenv("HOMEPAGE_RELOAD_S", "300")),
+}
+
+# The active calendars sorted by name, kept up to date as calendars are created by this process.
+_calendars: List[ActiveCalendar] = []
+_keys: set[str] = set()
+_loaded_at = None
+# Incremented every time the list changes.
+_version = 0
+# Maps the host the page was requested from (calendar URLs are absolute) to the version and rendered table.
+# The host comes from the request's Host header, so only the most recently used ones are kept.
+_MAX_HOSTS = 8
+_tables: OrderedDict[str, tuple[int, Markup]] = OrderedDict()
+_lock = Lock()
+
+
+def _sort_key(cal: ActiveCalendar) -> str:
+    return cal.name.lower()
+
+
+def _key(cal: ActiveCalendar) -> str:
+    return f"{'team' if cal.is_team else 'comp'}-cal/{cal.id}"
+
+
+def _reload() -> None:
+    global _loaded_at, _version
+    calendars = sorted(cache.list_cached_calendars(), key=_sort_key)
+    with _lock:
+        _calendars[:] = calendars
+        _keys.clear()
+        _keys.update(_key(c) for c in calendars)
+        _loaded_at = monotonic()
+        _version += 1
+
+
+def active_calendars() -> List[ActiveCalendar]:
+    """Returns the active calendars sorted by name."""
+    if _loaded_at is None or monotonic() - _loaded_at > config["reload_s"]:
+        _reload()
+    with _lock:
+        return list(_calendars)
+
+
+def table(host: str, render: Callable[[List[ActiveCalendar]], str]) -> Markup:
+    """Returns the table of active calendars rendered for the given host, rendering it only if the list changed."""
+    calendars = active_calendars()
+    with _lock:
+        version = _version
+        entry = _tables.get(host)
+        if entry is not None and entry[0] == version:
+            _tables.move_to_end(host)
+            return entry[1]
+
+    rendered = Markup(render(calendars))
+    with _lock:
+        _tables[host] = (version, rendered)
+        _tables.move_to_end(host)
+        while len(_tables) > _MAX_HOSTS:
+            _tables.popitem(last=False)
+    return rendered
+
+
+def on_update(key: str) -> None:
+    """Adds newly created calendars to the list."""
+    global _version
+    if not key.startswith(("team-cal/", "comp-cal/")):
+        return
+    if _loaded_at is None or key in _keys:
+        return
+    # The entry was just written, so it's in the L1 cache.
+    value, unused_ts = cache.latest(key)
+    cal = cache.active_calendar(key, value)
+    if cal is None:
+        return
+    with _lock:
+        if key in _keys:
+            return
+        insort(_calendars, cal, key=_sort_key)
+        _keys.add(key)
+        _version += 1
+
+
+cache.update_listeners.append(on_update)
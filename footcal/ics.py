@@ -0,0 +1,263 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from hashlib import sha1
+from os import getenv
+from threading import Lock
+from time import gmtime, strftime
+from typing import Iterable, Iterator
+
+import matches
+import metrics
+from custom_types import Match
+
+# A small RFC 5545 writer for the calendars we serve.
+# It writes the content lines directly instead of building icalendar's object model, and its output is
+# byte-for-byte the same as icalendar's (see benchmarks/ics_benchmark.py).
+
+CRLF = b"\r\n"
+# Lines longer than this (in octets, excluding the line break) are folded.
+MAX_LINE_OCTETS = 74
+_FOLD = b"\r\n "
+
+PRODID = "-//Footcal//footcal.cbdm.app//EN"
+_FOOTER = b"END:VCALENDAR" + CRLF
+
+
+def text(value: str) -> str:
+    """Escapes a TEXT value; same rules (and order) as icalendar."""
+    return (
+        value.replace(r"\N", "\n")
+        .replace("\\", "\\\\")
+        .replace(";", r"\;")
+        .replace(",", r"\,")
+        .replace("\r\n", r"\n")
+        .replace("\n", r"\n")
+    )
+
+
+def utc_timestamp(ts: int) -> str:
+    """Formats a unix timestamp as a UTC DATE-TIME."""
+    return strftime("%Y%m%dT%H%M%SZ", gmtime(ts))
+
+
+def utc_datetime(dt: datetime) -> str:
+    """Formats a naive UTC datetime as a UTC DATE-TIME (dropping the microseconds)."""
+    return f"{dt.year:04}{dt.month:02}{dt.day:02}T{dt.hour:02}{dt.minute:02}{dt.second:02}Z"
+
+
+def content_line(name: str, value: str) -> bytes:
+    """Returns the (folded) content line for the property, including the line break."""
+    line = f"{name}:{value}"
+    raw = line.encode("utf8")
+    if len(raw) <= MAX_LINE_OCTETS:
+        return raw + CRLF
+
+    if len(raw) == len(line):
+        # ASCII: every character is one octet.
+        return (
+            _FOLD.join(
+                raw[i : i + MAX_LINE_OCTETS]
+                for i in range(0, len(raw), MAX_LINE_OCTETS)
+            )
+            + CRLF
+        )
+
+    # Don't split multi-octet characters across lines.
+    parts = []
+    start = octets = 0
+    for i, char in enumerate(line):
+        char_octets = len(char.encode("utf8"))
+        octets += char_octets
+        if octets > MAX_LINE_OCTETS:
+            parts.append(line[start:i])
+            start, octets = i, char_octets
+    parts.append(line[start:])
+    return _FOLD.join(p.encode("utf8") for p in parts) + CRLF
+
+
+def header(name: str) -> bytes:
+    """Returns the start of a calendar with the given name, up to its first event."""
+    return b"".join(
+        (
+            b"BEGIN:VCALENDAR" + CRLF,
+            content_line("PRODID", text(PRODID)),
+            content_line("VERSION", "2.0"),
+            content_line("CALSCALE", "GREGORIAN"),
+            content_line("METHOD", "PUBLISH"),
+            content_line("X-WR-CALNAME", text(name)),
+            content_line("X-WR-TIMEZONE", "UTC"),
+        )
+    )
+
+
+def stamps(dtstamp: str) -> tuple[bytes, bytes, bytes]:
+    """Returns the DTSTAMP, CREATED, and LAST-MODIFIED lines shared by all events in a calendar."""
+    return (
+        content_line("DTSTAMP", dtstamp),
+        content_line("CREATED", dtstamp),
+        content_line("LAST-MODIFIED", dtstamp),
+    )
+
+
+def event_parts(
+    start_ts: int,
+    end_ts: int,
+    uid: str,
+    description: str,
+    location: str,
+    summary: str,
+) -> tuple[bytes, bytes, bytes, bytes]:
+    """Returns a VEVENT with our fixed set of properties, split around the lines from `stamps`.
+
+    This way the same parts can be used for calendars with different stamps.
+    """
+    return (
+        b"".join(
+            (
+                b"BEGIN:VEVENT" + CRLF,
+                content_line("DTSTART", utc_timestamp(start_ts)),
+                content_line("DTEND", utc_timestamp(end_ts)),
+            )
+        ),
+        content_line("UID", text(uid)),
+        content_line("DESCRIPTION", text(description)),
+        b"".join(
+            (
+                content_line("LOCATION", text(location)),
+                content_line("SEQUENCE", "0"),
+                content_line("STATUS", "CONFIRMED"),
+                content_line("SUMMARY", text(summary)),
+                content_line("TRANSP", "OPAQUE"),
+                b"END:VEVENT" + CRLF,
+            )
+        ),
+    )
+
+
+def join_event(
+    parts: tuple[bytes, bytes, bytes, bytes], stamp_lines: tuple[bytes, bytes, bytes]
+) -> bytes:
+    """Puts together the parts of an event and the calendar's stamps."""
+    return b"".join(
+        (
+            parts[0],
+            stamp_lines[0],
+            parts[1],
+            stamp_lines[1],
+            parts[2],
+            stamp_lines[2],
+            parts[3],
+        )
+    )
+
+
+def iter_calendar(name: str, events: Iterable[bytes]) -> Iterator[bytes]:
+    """Yields the calendar in chunks: the header, each of the events, and the footer."""
+    yield header(name)
+    yield from events
+    yield _FOOTER
+
+
+# How long each match event lasts in the calendar.
+MATCH_DURATION = timedelta(hours=2)
+
+# The written events, by the state of their fixture, so each one is only written once even if it's in
+# several calendars (e.g., the home team's, the away team's, and the competition's) or versions of them.
+fragment_config = {
+    "max_entries": int(getenv("ICS_FRAGMENTS_MAX_ENTRIES", "20000")),
+}
+_fragments: OrderedDict[tuple, tuple[bytes, bytes, bytes, bytes]] = OrderedDict()
+_fragments_lock = Lock()
+fragment_stats = {"hits": 0, "misses": 0}
+metrics.Exposed(
+    "footcal_ics_fragments_total",
+    "Events reused from (hit) or written for (miss) other versions of the calendars.",
+    "counter",
+    ("result",),
+    lambda: [(("hit",), fragment_stats["hits"]), (("miss",), fragment_stats["misses"])],
+)
+
+
+def match_teams(m: Match) -> str:
+    """Describes the match's teams (and its result or status, if relevant)."""
+    sep = "-"
+    if m.status in {"FT", "AET", "PEN"}:
+        sep = f"({m.home_score}) - ({m.away_score})"
+    notes = matches.status_map.get(m.status, "")
+    return f"{notes}{m.home_team_name} {sep} {m.away_team_name}"
+
+
+def _fragment_key(m: Match) -> tuple:
+    # Everything that shows up in the event; the status, score, kickoff, venue, and referee change the most.
+    return (
+        m.id,
+        m.status,
+        m.home_score,
+        m.away_score,
+        m.match_utc_ts,
+        m.venue_name,
+        m.venue_city,
+        m.ref_name,
+        m.league_id,
+        m.league_name,
+        m.home_team_id,
+        m.home_team_name,
+        m.away_team_id,
+        m.away_team_name,
+    )
+
+
+def content_digest(name: str, calendar_matches: Iterable[Match]) -> str:
+    """Returns a digest of everything in the calendar but its timestamps, to tell when its content changes."""
+    digest = sha1(name.encode("utf8"))
+    for m in sorted(calendar_matches, key=lambda m: m.id):
+        digest.update(repr(_fragment_key(m)).encode("utf8"))
+    return digest.hexdigest()
+
+
+def _match_event_parts(m: Match) -> tuple[bytes, bytes, bytes, bytes]:
+    local_uid = f"{strftime('%Y-%m-%d', gmtime(m.match_utc_ts))}_{m.league_id}_{m.home_team_id}_{m.away_team_id}"
+    local_uid = local_uid.replace(" ", "_")
+    return event_parts(
+        start_ts=m.match_utc_ts,
+        end_ts=m.match_utc_ts + int(MATCH_DURATION.total_seconds()),
+        uid=f"{local_uid}@footcal.cbdm.app",
+        description=f"Ref: {m.ref_name}",
+        location=f"{m.venue_name}, {m.venue_city}",
+        summary=f"[{m.league_name}] {match_teams(m)}",
+    )
+
+
+def clear_fragments() -> None:
+    """Drops all the written events."""
+    with _fragments_lock:
+        _fragments.clear()
+
+
+def match_event(m: Match, stamp_lines: tuple[bytes, bytes, bytes]) -> bytes:
+    """Returns the event for the match, reusing the parts written for the same state of the fixture."""
+    key = _fragment_key(m)
+    with _fragments_lock:
+        parts = _fragments.get(key)
+        if parts is not None:
+            _fragments.move_to_end(key)
+            fragment_stats["hits"] += 1
+    if parts is None:
+        parts = _match_event_parts(m)
+        with _fragments_lock:
+            fragment_stats["misses"] += 1
+            _fragments[key] = parts
+            while len(_fragments) > fragment_config["max_entries"]:
+                _fragments.popitem(last=False)
+    return join_event(parts, stamp_lines)
+
+
+def calendar(cache_data: dict, dtstamp: datetime) -> bytes:
+    """Writes the calendar for the cached team/competition with one event for each match."""
+    stamp_lines = stamps(utc_datetime(dtstamp))
+    return b"".join(
+        iter_calendar(
+            cache_data["info"].name,
+            (match_event(m, stamp_lines) for m in cache_data["matches"]),
+        )
+    )
@@ -0,0 +1,168 @@
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from hashlib import sha256
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Optional
+
+import background
+import cache
+import singleflight
+import upstream
+from custom_types import ActiveCalendar
+from sqlalchemy import Column, DateTime, LargeBinary, MetaData, String, Table, select
+from sqlalchemy.dialects import mysql
+
+logger = logging.getLogger(__name__)
+
+# Get the logo store config from environment variables.
+config = {
+    # Where the logo files are kept, named by the digest of their content; the DB has the canonical copy.
+    "dir": getenv("LOGO_DIR", os.path.join(tempfile.gettempdir(), "footcal-logos")),
+    # How long until we download a logo again.
+    "max_age": timedelta(weeks=float(getenv("LOGO_MAX_AGE_WEEKS", "104"))),
+    # How long browsers can keep a logo without checking with us.
+    "browser_max_age_s": int(getenv("LOGO_BROWSER_MAX_AGE_S", str(30 * 24 * 3600))),
+    # How often the logos of all active calendars are checked.
+    "prefetch_every": timedelta(hours=float(getenv("LOGO_PREFETCH_EVERY_H", "6"))),
+}
+
+# Logos are stored once per content digest, separately from the cached (JSON) data.
+_metadata = MetaData()
+logos_table = Table(
+    "logos",
+    _metadata,
+    # The same key used by the logo's URL, e.g. "team/33".
+    Column("name", String(100), primary_key=True),
+    Column("digest", String(64), nullable=False),
+    Column(
+        "content",
+        LargeBinary().with_variant(mysql.MEDIUMBLOB(), "mysql"),
+        nullable=False,
+    ),
+    Column("fetched_at", DateTime, nullable=False),
+)
+
+# Maps the logo's name to its digest and when it was fetched, for the logos whose file is on disk.
+_known: dict[str, tuple[str, datetime]] = {}
+_lock = Lock()
+_last_prefetch: Optional[float] = None
+
+
+def init(app) -> None:
+    """Creates the logos table and directory if they don't exist."""
+    with app.app_context():
+        _metadata.create_all(cache.db.engine)
+    os.makedirs(config["dir"], exist_ok=True)
+
+
+def logo_name(type: str, id: str) -> str:
+    return f"{type}/{id}"
+
+
+def file_path(digest: str) -> str:
+    return os.path.join(config["dir"], f"{digest}.png")
+
+
+def _write_file(digest: str, content: bytes) -> None:
+    path = file_path(digest)
+    if os.path.exists(path):
+        return
+    # Write to a temporary file first so no one reads a partial logo.
+    fd, tmp_path = tempfile.mkstemp(dir=config["dir"])
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _remember(name: str, digest: str, fetched_at: datetime) -> None:
+    with _lock:
+        _known[name] = (digest, fetched_at)
+
+
+def _store(name: str, content: bytes, fetched_at: datetime) -> str:
+    digest = sha256(content).hexdigest()
+    _write_file(digest, content)
+    with cache.db.engine.begin() as conn:
+        conn.execute(logos_table.delete().where(logos_table.c.name == name))
+        conn.execute(
+            logos_table.insert().values(
+                name=name, digest=digest, content=content, fetched_at=fetched_at
+            )
+        )
+    _remember(name, digest, fetched_at)
+    return digest
+
+
+def _load(names: list[str]) -> None:
+    """Puts the files for the given logos on disk, if we have them in the DB."""
+    stmt = select(logos_table).where(logos_table.c.name.in_(names))
+    with cache.db.engine.connect() as conn:
+        for row in conn.execute(stmt):
+            _write_file(row.digest, row.content)
+            _remember(row.name, row.digest, row.fetched_at)
+
+
+def _download(type: str, id: str) -> Optional[str]:
+    name = logo_name(type, id)
+    # Check the DB again in case another process downloaded it while we waited.
+    _load([name])
+    with _lock:
+        known = _known.get(name)
+    if known is not None and known[1] + config["max_age"] >= datetime.utcnow():
+        return known[0]
+
+    # Move the logos cached by older versions to the store.
+    legacy, fresh, ts = cache.query_entry(f"logo/{type}/{id}", config["max_age"])
+    if fresh and legacy:
+        return _store(name, legacy, ts)
+
+    resp = upstream.logo_get(type, id)
+    if resp.status_code != 200:
+        logger.warning(f"could not download the logo for {name}: {resp.status_code}")
+        # Keep serving the logo we have, if any.
+        return known[0] if known is not None else None
+    return _store(name, resp.content, datetime.utcnow())
+
+
+def get(type: str, id: str) -> Optional[str]:
+    """Returns the digest of the logo for the given team/competition (its file is on disk), or None if there's none."""
+    name = logo_name(type, id)
+    with _lock:
+        known = _known.get(name)
+    if (
+        known is not None
+        and known[1] + config["max_age"] >= datetime.utcnow()
+        # Someone could have cleaned up the directory.
+        and os.path.exists(file_path(known[0]))
+    ):
+        return known[0]
+    return singleflight.run(f"logo/{name}", lambda: _download(type, id))
+
+
+def _prefetch(calendars: list[ActiveCalendar]) -> None:
+    names = {logo_name("team" if c.is_team else "comp", c.id): c for c in calendars}
+    _load(list(names))
+    for name, c in names.items():
+        with _lock:
+            known = name in _known
+        if not known:
+            get("team" if c.is_team else "comp", c.id)
+
+
+def prefetch(calendars: Iterable[ActiveCalendar]) -> None:
+    """Makes sure the logos of the given calendars are on disk, in the background, every once in a while."""
+    global _last_prefetch
+    with _lock:
+        now = monotonic()
+        if (
+            _last_prefetch is not None
+            and now - _last_prefetch < config["prefetch_every"].total_seconds()
+        ):
+            return
+        _last_prefetch = now
+    calendars = list(calendars)
+    background.submit("logos/prefetch", lambda: _prefetch(calendars))
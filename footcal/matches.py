@@ -1,11 +1,98 @@
 import json
-from datetime import date, timedelta
-from typing import List
-
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import date, datetime, timedelta
+from os import getenv
+from threading import Lock
+from typing import Callable, List, Optional
+
+import background
 import cache
-import requests
-from auth import APIURL, HEADERS, REQUEST_TIMEOUT_S
-from custom_types import Competition, Match, Team
+import feeds
+import fixtures
+import ics
+import metrics
+import singleflight
+import upstream
+from custom_types import (
+    Competition,
+    FixtureWindow,
+    Match,
+    QuotaExceeded,
+    Team,
+    UpstreamBusy,
+    UpstreamError,
+)
+
+# How long a cached calendar is considered fresh.
+CALENDAR_MAX_AGE = timedelta(days=1)
+
+# How often we ask the API which matches a team has coming up.
+# In between, team calendars are built from the fixtures of the competitions the team plays in,
+# which are requested once for all of their teams.
+TEAM_DISCOVERY_MAX_AGE = timedelta(days=7)
+
+# Statuses used by api-football for matches that are in play.
+LIVE_STATUSES = {"1H", "HT", "2H", "ET", "BT", "P", "SUSP", "INT", "LIVE"}
+FINISHED_STATUSES = {"FT", "AET", "PEN"}
+# Statuses of matches that won't change anymore.
+FINAL_STATUSES = FINISHED_STATUSES | {"CANC", "ABD", "AWD", "WO"}
+# Statuses of matches that are waiting for a new date.
+UNSCHEDULED_STATUSES = {"PST", "TBD"}
+
+# How long a match can take from kickoff until it has a final result.
+MATCH_WINDOW = timedelta(hours=3)
+
+# Calendars are fully requested again once a day; in between, refreshes only request the matches that
+# might have changed: the ones being played, about to start, or waiting for a new date.
+UPCOMING_WINDOW = timedelta(days=1)
+# Matches that another calendar updated this recently are not requested again.
+FIXTURE_MIN_AGE = timedelta(minutes=5)
+# How many fixtures can be requested at once by id.
+MAX_IDS_PER_REQUEST = 20
+
+# Stale calendars are served right away while they're refreshed in the background (stale-while-revalidate),
+# unless they are older than the hard expiry; those are never served and callers wait for the refresh.
+swr_config = {
+    "enabled": getenv("CALENDAR_SWR_ENABLED", "true").lower() in ("1", "true", "yes"),
+    "hard_max_age": timedelta(hours=float(getenv("CALENDAR_HARD_MAX_AGE_H", "168"))),
+}
+
+# How old the stale calendars we served were; the buckets are upper bounds in hours.
+STALENESS_BUCKETS_H = (25, 30, 36, 48, 72, 168)
+stale_stats = {
+    "served": 0,
+    "hard_expired": 0,
+    "max_age_s": 0.0,
+    "buckets": {b: 0 for b in STALENESS_BUCKETS_H + (float("inf"),)},
+}
+_stats_lock = Lock()
+metrics.Exposed(
+    "footcal_stale_calendars_served_total",
+    "Stale calendars served while they were refreshed, by the bucket of their age in hours.",
+    "counter",
+    ("max_age_h",),
+    lambda: [((b,), n) for b, n in stale_stats["buckets"].items()],
+)
+metrics.Exposed(
+    "footcal_stale_calendars_expired_total",
+    "Stale calendars that were too old to serve.",
+    "counter",
+    (),
+    lambda: [((), stale_stats["hard_expired"])],
+)
+
+# Threads used to make independent API requests in parallel.
+_upstream_pool = ThreadPoolExecutor(
+    max_workers=int(getenv("UPSTREAM_WORKERS", "8")),
+    thread_name_prefix="footcal-upstream",
+)
+
+
+def _submit(fn: Callable, *args) -> Future:
+    """Runs the function in the upstream pool with the caller's context (e.g., the priority of its API requests)."""
+    return _upstream_pool.submit(copy_context().run, fn, *args)
+
 
 # Maps the api-football status to messages to be displayed.
 status_map = {
@@ -22,49 +109,106 @@ def get_matches_in_window(
     team: bool, id: str, start_date: date, end_date: date, season: str
 ) -> str:
     """Requests the relevant matches for the given team/competition."""
-    mresp = requests.get(
-        f"{APIURL}/fixtures",
+    mresp = upstream.api_get(
+        "fixtures",
         params={
             "team" if team else "league": id,
             "from": start_date.isoformat(),
             "to": end_date.isoformat(),
             "season": season,
         },
-        headers=HEADERS,
-        timeout=REQUEST_TIMEOUT_S,
     )
-
+    # The window's fixtures replace the ones we have, so never mistake an error for a window without matches.
+    upstream.check(mresp)
     return mresp.text
 
 
 def get_next_n_matches(team_id: str, n: int) -> str:
     """Requests the next n matches for the given **team**."""
-    mresp = requests.get(
-        f"{APIURL}/fixtures",
+    mresp = upstream.api_get(
+        "fixtures",
         params={
             "team": team_id,
             "next": n,
         },
-        headers=HEADERS,
-        timeout=REQUEST_TIMEOUT_S,
     )
+    upstream.check(mresp)
     return mresp.text
 
 
 def get_last_n_matches(team_id: str, n: int) -> str:
     """Requests the last n matches for the given **team**."""
-    mresp = requests.get(
-        f"{APIURL}/fixtures",
+    mresp = upstream.api_get(
+        "fixtures",
         params={
             "team": team_id,
             "last": n,
         },
-        headers=HEADERS,
-        timeout=REQUEST_TIMEOUT_S,
     )
+    upstream.check(mresp)
     return mresp.text
 
 
+def get_fixtures_by_id(ids: List[int]) -> List[Match]:
+    """Requests the given fixtures, a few at a time."""
+    batches = [
+        ids[i : i + MAX_IDS_PER_REQUEST]
+        for i in range(0, len(ids), MAX_IDS_PER_REQUEST)
+    ]
+    reqs = [
+        _submit(
+            lambda batch=batch: upstream.api_get(
+                "fixtures", params={"ids": "-".join(str(id) for id in batch)}
+            )
+        )
+        for batch in batches
+    ]
+    resps = [req.result() for req in reqs]
+    for resp in resps:
+        upstream.check(resp)
+    return [m for resp in resps for m in parse_matches(resp.text)]
+
+
+def get_team_info(team_id: str) -> Team:
+    """Requests the information for the given **team**."""
+    tresp = upstream.api_get(
+        "teams",
+        params={"id": f"{team_id}"},
+    )
+    upstream.check(tresp)
+    data = json.loads(tresp.text)["response"][0]
+    return Team(
+        id=data["team"]["id"],
+        name=data["team"]["name"],
+        short_name=data["team"]["code"],
+        country=data["team"]["country"],
+        founded=data["team"]["founded"],
+        club=not data["team"]["national"],
+        logo=data["team"]["logo"],
+    )
+
+
+def get_comp_info(comp_id: str) -> Competition:
+    """Requests the information for the given **competition**, including its latest season."""
+    cresp = upstream.api_get(
+        "leagues",
+        params={"id": f"{comp_id}"},
+    )
+    upstream.check(cresp)
+    data = json.loads(cresp.text)["response"][0]
+    return Competition(
+        id=data["league"]["id"],
+        name=data["league"]["name"],
+        type=data["league"]["type"],
+        logo=data["league"]["logo"],
+        country_name=data["country"]["name"],
+        country_code=data["country"]["code"],
+        season=data["seasons"][-1]["year"],
+        season_start=data["seasons"][-1]["start"],
+        season_end=data["seasons"][-1]["end"],
+    )
+
+
 def parse_matches(mresp: str) -> List[Match]:
     """Parses the response into Match objects that will be used to create calendars."""
     data = json.loads(mresp)["response"]
@@ -85,84 +229,415 @@ def parse_matches(mresp: str) -> List[Match]:
             status=match["fixture"]["status"]["short"],
             home_score=match["score"].get("fulltime", {}).get("home"),
             away_score=match["score"].get("fulltime", {}).get("away"),
+            season=match["league"].get("season"),
         )
         for match in data
     ]
 
 
-def fetch_team(
+def kickoff_index(matches: List[Match]) -> tuple[List[int], List[Match]]:
+    """Sorts the matches by kickoff time and returns the kickoff timestamps along with them, so they can be bisected."""
+    sorted_matches = sorted(matches, key=lambda m: m.match_utc_ts)
+    return [m.match_utc_ts for m in sorted_matches], sorted_matches
+
+
+def default_window(today: date) -> tuple[date, date]:
+    """Returns the range of dates covered by competition calendars by default."""
+    # Results from up to a week ago and future matches for the next three months.
+    return today - timedelta(weeks=1, days=1), today + timedelta(weeks=12)
+
+
+def _fixture_window(league_id: int, season: int, start: str, end: str) -> FixtureWindow:
+    epoch = date(1970, 1, 1)
+    return FixtureWindow(
+        league_id=int(league_id),
+        season=season,
+        start_ts=(date.fromisoformat(start) - epoch) // timedelta(seconds=1),
+        # The end date is inclusive.
+        end_ts=(date.fromisoformat(end) + timedelta(days=1) - epoch)
+        // timedelta(seconds=1),
+    )
+
+
+def window_key(league_id: int) -> str:
+    """Returns the cache key used to record the window of fixtures requested for a competition."""
+    return f"fixture-window/{league_id}"
+
+
+def _has_fresh_window(
+    key: str, season: int, use_l1: bool = True, record: bool = True
+) -> bool:
+    data, fresh, unused_ts = cache.query_entry(
+        key, max_age=CALENDAR_MAX_AGE, use_l1=use_l1, record=record
+    )
+    return fresh and bool(data.get("window")) and data.get("season") == season
+
+
+def _ensure_league_window(league_id: int, season: int) -> None:
+    """Makes sure the fixtures table has a fresh window of the competition's fixtures."""
+    # The competition's calendar or a previous request for its window might have stored them already.
+    if _has_fresh_window(calendar_key(False, league_id), season) or _has_fresh_window(
+        window_key(league_id), season
+    ):
+        return
+
+    singleflight.run(
+        window_key(league_id), lambda: _refresh_league_window(league_id, season)
+    )
+
+
+def _refresh_league_window(league_id: int, season: int) -> None:
+    # Check the DB again in case another process requested the window while we waited.
+    lookup_key = window_key(league_id)
+    if _has_fresh_window(lookup_key, season, use_l1=False, record=False):
+        return
+
+    start_date, end_date = default_window(date.today())
+    mresp = get_matches_in_window(False, league_id, start_date, end_date, season)
+    window = [start_date.isoformat(), end_date.isoformat()]
+    matches = parse_matches(mresp)
+    _update_moved(_fixture_window(league_id, season, *window), matches)
+    fixtures.upsert(matches)
+    cache.update(lookup_key, {"season": season, "window": window})
+
+
+def _update_moved(window: FixtureWindow, matches: List[Match]) -> None:
+    """Updates the stored fixtures that moved out of the window (e.g., rescheduled) with their new kickoff."""
+    # They're shared with other calendars, so they have to be updated instead of dropped.
+    moved = fixtures.moved_from_window(window, (m.id for m in matches))
+    if moved:
+        fixtures.upsert(get_fixtures_by_id(moved))
+
+
+def _team_matches_from_store(
+    team_id: str, known_matches: List[Match], num_next_games: int, num_last_games: int
+) -> Optional[List[Match]]:
+    """Builds the team's matches from its competitions' fixtures; returns None if we can't."""
+    # Find the competitions (and their current seasons) from the matches we already know.
+    leagues = {m.league_id: m.season for m in known_matches if m.season is not None}
+    if not leagues:
+        return None
+
+    for league_id, season in leagues.items():
+        _ensure_league_window(league_id, season)
+
+    now_ts = (datetime.utcnow() - datetime(1970, 1, 1)) // timedelta(seconds=1)
+    team_fixtures = fixtures.team_matches(int(team_id), leagues)
+    next_matches = [m for m in team_fixtures if m.match_utc_ts >= now_ts]
+    last_matches = [m for m in team_fixtures if m.match_utc_ts < now_ts]
+
+    # The team might be starting a new season or competition that we don't know about yet.
+    if not next_matches:
+        return None
+
+    return next_matches[:num_next_games] + last_matches[::-1][:num_last_games]
+
+
+def _may_change(m: Match, now_ts: int) -> bool:
+    """Returns whether the match could have changed since it was requested."""
+    if m.status in FINAL_STATUSES:
+        return False
+    since_kickoff = timedelta(seconds=now_ts - m.match_utc_ts)
+    return (
+        m.status in LIVE_STATUSES
+        or m.status in UNSCHEDULED_STATUSES
+        or -UPCOMING_WINDOW <= since_kickoff <= 2 * MATCH_WINDOW
+    )
+
+
+def _refresh_changed(lookup_key: str, cached: dict) -> Optional[tuple[dict, datetime]]:
+    """Only requests the calendar's matches that might have changed; returns None if it needs a full refresh."""
+    synced_at = cached.get("synced_at")
+    if (
+        synced_at is None
+        or datetime.fromisoformat(synced_at) + CALENDAR_MAX_AGE < datetime.utcnow()
+    ):
+        return None
+
+    now = datetime.utcnow()
+    now_ts = (now - datetime(1970, 1, 1)) // timedelta(seconds=1)
+    ids = [m.id for m in cached["matches"] if _may_change(m, now_ts)]
+
+    # Use the updates made for other calendars with the same matches (e.g., the opponent's).
+    updated = fixtures.updated_since(ids, now - FIXTURE_MIN_AGE)
+    changed = get_fixtures_by_id([id for id in ids if id not in updated])
+    for m in changed:
+        updated[m.id] = m
+
+    matches = [updated.get(m.id, m) for m in cached["matches"]]
+    return _store_calendar(lookup_key, {**cached, "matches": matches}, changed=changed)
+
+
+def _record_stale(age: timedelta) -> None:
+    age_h = age.total_seconds() / 3600
+    with _stats_lock:
+        stale_stats["served"] += 1
+        stale_stats["max_age_s"] = max(stale_stats["max_age_s"], age.total_seconds())
+        for b in stale_stats["buckets"]:
+            if age_h <= b:
+                stale_stats["buckets"][b] += 1
+                break
+
+
+def _serve_stale(
+    lookup_key: str, cached: dict, ts: datetime, refresh: Callable
+) -> tuple[dict, datetime]:
+    """Returns the calendar for an entry that is not fresh anymore, refreshing it as needed."""
+    now = datetime.utcnow()
+    stale = (cached, ts) if cached is not None else None
+
+    # Don't serve data that is past the hard expiry.
+    if stale is not None and ts + swr_config["hard_max_age"] < now:
+        with _stats_lock:
+            stale_stats["hard_expired"] += 1
+        stale = None
+
+    # Serve the stale data right away and refresh it in the background.
+    if stale is not None and swr_config["enabled"]:
+        background.submit(lookup_key, lambda: singleflight.run(lookup_key, refresh))
+        _record_stale(now - ts)
+        return stale
+
+    # Only one caller refreshes the calendar at a time; the others wait for it or get the stale data.
+    try:
+        return singleflight.run(lookup_key, refresh, stale=stale)
+    except (QuotaExceeded, UpstreamBusy, UpstreamError):
+        # Out of API quota (or too busy to wait for it, or it failed); serve whatever we have, even if it's past the hard expiry.
+        if cached is not None:
+            return cached, ts
+        raise
+
+
+def calendar_key(team: bool, id: str) -> str:
+    """Returns the cache key used to store the calendar for the given team/competition."""
+    return f"{'team' if team else 'comp'}-cal/{id}"
+
+
+# Fields of the calendars that are filled in from the fixtures table instead of being stored with them.
+_FROM_FIXTURES = ("matches", "fixtures_updated_at")
+
+
+def _with_matches(key: str, data: Optional[dict], ts: datetime) -> Optional[dict]:
+    """Fills in the calendar's matches (and when they were last updated) from the fixtures table."""
+    # Calendars written by older versions still have their matches inline.
+    if data is None or "matches" in data:
+        return data
+    matches, updated_at = feeds.get(
+        key, ts, "matches", lambda: fixtures.calendar_matches(key)
+    )
+    return {**data, "matches": matches, "fixtures_updated_at": updated_at}
+
+
+def _content_version(data: dict, ts: datetime) -> tuple[str, datetime]:
+    digest = ics.content_digest(data["info"].name, data["matches"])
+    changed_at = data.get("changed_at")
+    modified = ts if changed_at is None else datetime.fromisoformat(changed_at)
+    # Other calendars' refreshes can update the fixtures it shares with them after it was stored.
+    updated_at = data.get("fixtures_updated_at")
+    if digest != data.get("content_digest") and updated_at is not None:
+        modified = max(modified, updated_at)
+    return digest, modified
+
+
+def content_version(key: str, data: dict, ts: datetime) -> tuple[str, datetime]:
+    """Returns a digest of the calendar's content and when it last changed, given the data and timestamp returned
+    by `fetch_entry`.
+
+    Refreshes that don't change anything keep the calendar's content (and its events' timestamps) as they were.
+    """
+    return feeds.get(key, ts, "content", lambda: _content_version(data, ts))
+
+
+def query_calendar(
+    key: str, max_age: timedelta, use_l1: bool = True, record: bool = True
+) -> tuple[Optional[dict], bool, Optional[datetime]]:
+    """Same as `cache.query_entry`, but for calendars (which keep their matches in the fixtures table)."""
+    data, fresh, ts = cache.query_entry(
+        key, max_age=max_age, use_l1=use_l1, record=record
+    )
+    return _with_matches(key, data, ts), fresh, ts
+
+
+def _store_calendar(
+    key: str, data: dict, changed: Optional[List[Match]] = None
+) -> tuple[dict, datetime]:
+    """Stores the calendar's matches in the fixtures table and the rest of its data in the cache.
+
+    If the calendar has the same matches as before, pass the ones that `changed` so only those are written.
+    """
+    # The next and last matches of a team can overlap (e.g., while a match is being played).
+    unique = {m.id: m for m in data["matches"]}
+    matches = sorted(unique.values(), key=lambda m: m.match_utc_ts)
+    if changed is None:
+        fixtures.save_calendar(key, matches)
+    else:
+        fixtures.upsert(changed)
+    stored = {k: v for k, v in data.items() if k not in _FROM_FIXTURES}
+    # Only move the time the content changed when it actually did (e.g., not for a refresh without updates).
+    stored["content_digest"] = ics.content_digest(data["info"].name, matches)
+    previous, unused_ts = cache.latest(key)
+    if (
+        previous
+        and previous.get("content_digest") == stored["content_digest"]
+        and previous.get("changed_at")
+    ):
+        stored["changed_at"] = previous["changed_at"]
+    else:
+        stored["changed_at"] = datetime.utcnow().isoformat()
+    ts = cache.update(key, stored)
+    # Read the matches back so we serve what every other process will (e.g., the fixtures we didn't request
+    # could have been updated by other calendars).
+    return _with_matches(key, stored, ts), ts
+
+
+def fetch_team_entry(
     team_id: str,
     num_next_games: int = 10,
     num_last_games: int = 5,
-) -> List[Match]:
+) -> tuple[dict, datetime]:
+    """Returns the calendar data for the given team and the timestamp of when it was cached."""
     # Check if we have this calendar cached.
-    lookup_key = f"team-cal/{team_id}"
-    cached, fresh = cache.query(lookup_key, max_age=timedelta(days=1))
+    lookup_key = calendar_key(True, team_id)
+    cached, fresh, ts = query_calendar(lookup_key, max_age=CALENDAR_MAX_AGE)
 
     # Return cached data if it's still fresh.
     if fresh:
-        return cached
+        return cached, ts
+
+    return _serve_stale(
+        lookup_key,
+        cached,
+        ts,
+        lambda: _refresh_team(team_id, num_next_games, num_last_games),
+    )
+
+
+def _refresh_team(
+    team_id: str,
+    num_next_games: int = 10,
+    num_last_games: int = 5,
+    max_age: timedelta = CALENDAR_MAX_AGE,
+) -> tuple[dict, datetime]:
+    # Check the DB again in case another process refreshed the calendar while we waited.
+    lookup_key = calendar_key(True, team_id)
+    cached, fresh, ts = query_calendar(
+        lookup_key, max_age=max_age, use_l1=False, record=False
+    )
+    if fresh:
+        return cached, ts
+
+    # Most of the time only a few of the calendar's matches might have changed.
+    if cached is not None:
+        refreshed = _refresh_changed(lookup_key, cached)
+        if refreshed is not None:
+            return refreshed
 
     # Replace None with an empty dict so it's easier to work with.
     if cached is None:
         cached = {}
 
-    # Search information for the team or competition if it hasn't been cached or the season for competition is over.
+    # Between discoveries, build the calendar from the fixtures of the team's competitions.
     obj = cached.get("info")
-    if obj is None:
-        tresp = requests.get(
-            f"{APIURL}/teams",
-            params={"id": f"{team_id}"},
-            headers=HEADERS,
-            timeout=REQUEST_TIMEOUT_S,
-        )
-        data = json.loads(tresp.text)["response"][0]
-        obj = Team(
-            id=data["team"]["id"],
-            name=data["team"]["name"],
-            short_name=data["team"]["code"],
-            country=data["team"]["country"],
-            founded=data["team"]["founded"],
-            club=not data["team"]["national"],
-            logo=data["team"]["logo"],
+    matches = None
+    discovered_at = cached.get("discovered_at")
+    if (
+        obj is not None
+        and discovered_at is not None
+        and datetime.fromisoformat(discovered_at) + TEAM_DISCOVERY_MAX_AGE
+        >= datetime.utcnow()
+    ):
+        matches = _team_matches_from_store(
+            team_id, cached.get("matches", []), num_next_games, num_last_games
         )
 
-    # Check if could not find any information for the given ID.
-    if obj is None:
-        return None
-
-    # Request and parse matches.
-    # For teams, use the next and last parameters so we don't have to figure out the season.
-    next_matches = get_next_n_matches(team_id, num_next_games)
-    last_matches = get_last_n_matches(team_id, num_last_games)
-    matches = parse_matches(next_matches) + parse_matches(last_matches)
+    if matches is None:
+        # Request the team's information (if it hasn't been cached) and its matches in parallel.
+        # For teams, use the next and last parameters so we don't have to figure out the season.
+        info_req = None
+        if obj is None:
+            info_req = _submit(get_team_info, team_id)
+        next_req = _submit(get_next_n_matches, team_id, num_next_games)
+        last_req = _submit(get_last_n_matches, team_id, num_last_games)
+        if info_req is not None:
+            obj = info_req.result()
+
+        # Check if could not find any information for the given ID.
+        if obj is None:
+            return None, None
+
+        # Parse matches.
+        matches = parse_matches(next_req.result()) + parse_matches(last_req.result())
+        discovered_at = datetime.utcnow().isoformat()
 
     # Create cache entry.
     new_data = {
         "info": obj,
         "season": "N/A",
         "matches": matches,
+        "discovered_at": discovered_at,
+        "synced_at": datetime.utcnow().isoformat(),
     }
 
     # Add the newly created calendar.
-    cache.update(lookup_key, new_data)
+    return _store_calendar(lookup_key, new_data)
 
-    return new_data
 
+def fetch_team(
+    team_id: str,
+    num_next_games: int = 10,
+    num_last_games: int = 5,
+) -> List[Match]:
+    return fetch_team_entry(team_id, num_next_games, num_last_games)[0]
 
-def fetch_comp(
+
+def fetch_comp_entry(
     comp_id: str,
     start_date: date = None,
     end_date: date = None,
     season: str = None,
-) -> List[Match]:
+) -> tuple[dict, datetime]:
+    """Returns the calendar data for the given competition and the timestamp of when it was cached."""
     # Check if we have this calendar cached.
-    lookup_key = f"comp-cal/{comp_id}"
-    cached, fresh = cache.query(lookup_key, max_age=timedelta(days=1))
+    lookup_key = calendar_key(False, comp_id)
+    cached, fresh, ts = query_calendar(lookup_key, max_age=CALENDAR_MAX_AGE)
 
     # Return cached data if it's still fresh.
     if fresh:
-        return cached
+        return cached, ts
+
+    return _serve_stale(
+        lookup_key,
+        cached,
+        ts,
+        lambda: _refresh_comp(comp_id, start_date, end_date, season),
+    )
+
+
+def _refresh_comp(
+    comp_id: str,
+    start_date: date = None,
+    end_date: date = None,
+    season: str = None,
+    max_age: timedelta = CALENDAR_MAX_AGE,
+) -> tuple[dict, datetime]:
+    # Check the DB again in case another process refreshed the calendar while we waited.
+    lookup_key = calendar_key(False, comp_id)
+    cached, fresh, ts = query_calendar(
+        lookup_key, max_age=max_age, use_l1=False, record=False
+    )
+    if fresh:
+        return cached, ts
+
+    # Most of the time only a few of the calendar's matches might have changed.
+    if (
+        cached is not None
+        and start_date is None
+        and end_date is None
+        and season is None
+    ):
+        refreshed = _refresh_changed(lookup_key, cached)
+        if refreshed is not None:
+            return refreshed
 
     # Replace None with an empty dict so it's easier to work with.
     if cached is None:
@@ -171,71 +646,87 @@ def fetch_comp(
     # Get today's date to find season's year and future games.
     today = date.today()
 
-    # Search information for the team or competition if it hasn't been cached or the season for competition is over.
-    obj = cached.get("info")
-    if (obj is None) or (obj.season_end < today.isoformat()):
-        cresp = requests.get(
-            f"{APIURL}/leagues",
-            params={"id": f"{comp_id}"},
-            headers=HEADERS,
-            timeout=REQUEST_TIMEOUT_S,
-        )
-        data = json.loads(cresp.text)["response"][0]
-        obj = Competition(
-            id=data["league"]["id"],
-            name=data["league"]["name"],
-            type=data["league"]["type"],
-            logo=data["league"]["logo"],
-            country_name=data["country"]["name"],
-            country_code=data["country"]["code"],
-            season=data["seasons"][-1]["year"],
-            season_start=data["seasons"][-1]["start"],
-            season_end=data["seasons"][-1]["end"],
-        )
-
-    # Check if could not find any information for the given ID.
-    if obj is None:
-        return None
-
     # Create default calendar window if not given.
-    if start_date is None:
-        # Defaults to results from up to a week ago.
-        start_date = today - timedelta(weeks=1, days=1)
+    default_start_date, default_end_date = default_window(today)
+    start_date = start_date or default_start_date
+    end_date = end_date or default_end_date
 
-    if end_date is None:
-        # Future matches for the next three months.
-        end_date = today + timedelta(weeks=12)
-
-    # Request and parse matches.
     # For competitions, find matches using the original method.
     # For a given season, find all matches that happen between last week and 3 months from now.
     # Find the current season to query the matches.
     # TODO: Could add a timestamp of when the season was updated and only recheck after a week or so.
     season = season if season else cached.get("season")
-    if season is None or (cached and (not cached.get("matches"))):
+    if cached and (not cached.get("matches")):
+        # Recheck the latest season for the competition.
+        season = None
+
+    # If we already know the season, request the matches while we (maybe) update the competition's information.
+    mreq = None
+    if season is not None:
+        mreq = _submit(
+            get_matches_in_window, False, comp_id, start_date, end_date, season
+        )
+
+    # Search information for the competition if it hasn't been cached or the season is over.
+    obj = cached.get("info")
+    if (obj is None) or (obj.season_end < today.isoformat()):
+        obj = get_comp_info(comp_id)
+
+    # Check if could not find any information for the given ID.
+    if obj is None:
+        return None, None
+
+    # Request and parse matches.
+    if mreq is None:
         # Get the latest season for the competition.
         season = obj.season
-    mresp = get_matches_in_window(False, comp_id, start_date, end_date, season)
-    matches = parse_matches(mresp)
+        mreq = _submit(
+            get_matches_in_window, False, comp_id, start_date, end_date, season
+        )
+    matches = parse_matches(mreq.result())
 
     # Create cache entry.
     new_data = {
         "info": obj,
         "season": season,
+        "window": [start_date.isoformat(), end_date.isoformat()],
         "matches": matches,
+        "synced_at": datetime.utcnow().isoformat(),
     }
 
-    # Add the newly created calendar.
-    cache.update(lookup_key, new_data)
+    # Add the newly created calendar; its fixtures are shared with the calendars of the competition's teams.
+    _update_moved(_fixture_window(comp_id, season, *new_data["window"]), matches)
+    return _store_calendar(lookup_key, new_data)
 
-    return new_data
+
+def fetch_comp(
+    comp_id: str,
+    start_date: date = None,
+    end_date: date = None,
+    season: str = None,
+) -> List[Match]:
+    return fetch_comp_entry(comp_id, start_date, end_date, season)[0]
+
+
+def fetch_entry(team: bool, id: str) -> tuple[dict, datetime]:
+    """Same as `fetch`, but also returns the timestamp of when the data was cached."""
+    if team:
+        return fetch_team_entry(id)
+    else:
+        return fetch_comp_entry(id)
 
 
 def fetch(team: bool, id: str) -> List[Match]:
+    return fetch_entry(team, id)[0]
+
+
+def refresh_entry(team: bool, id: str, max_age: timedelta) -> tuple[dict, datetime]:
+    """Refreshes the calendar for the given team/competition unless it was updated within `max_age`."""
     if team:
-        return fetch_team(id)
+        refresh = lambda: _refresh_team(id, max_age=max_age)
     else:
-        return fetch_comp(id)
+        refresh = lambda: _refresh_comp(id, max_age=max_age)
+    return singleflight.run(calendar_key(team, id), refresh)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import getenv
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterable, Iterator
+
+from flask import g, request
+from sqlalchemy import event
+
+# Get the metrics config from environment variables.
+config = {
+    # If set, /metrics can only be read with an "Authorization: Bearer <token>" header.
+    "token": getenv("METRICS_TOKEN"),
+}
+
+# Upper bounds of the histogram buckets; latencies are in seconds.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Everything that is exposed, in the order it was registered.
+# Note that the values are per process; each worker is scraped (and counted) separately.
+_registry: list = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Iterable[str], values: Iterable, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _sort_key(item: tuple) -> tuple:
+    # Label values can be of different types (e.g., a status code or "error").
+    return tuple(str(v) for v in item[0])
+
+
+class Counter:
+    """A value that only goes up, for each combination of label values."""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items(), key=_sort_key)
+        for label_values, value in values:
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+
+class Histogram:
+    """Counts the observed values by bucket, for each combination of label values."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # Maps the label values to the count in each bucket (not cumulative) and the sum of the values.
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = ([0] * len(self.buckets), [0.0])
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, *label_values) -> Iterator[None]:
+        """Observes how long the block takes."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *label_values)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted(
+                (
+                    (k, (list(counts), total[0]))
+                    for k, (counts, total) in self._values.items()
+                ),
+                key=_sort_key,
+            )
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labels, label_values, f'le="{_number(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_number(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Exposed:
+    """Values that are kept elsewhere (e.g., a module's stats) and read when the metrics are scraped."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        labels: tuple[str, ...],
+        read: Callable[[], Iterable[tuple[tuple, float]]],
+    ):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.read = read
+        _registry.append(self)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for label_values, value in self.read():
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+
+def render() -> str:
+    """Returns all the metrics in the Prometheus text format."""
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+def authorized(authorization: str) -> bool:
+    """Returns whether the request's Authorization header allows reading the metrics."""
+    return not config["token"] or authorization == f"Bearer {config['token']}"
+
+
+http_requests = Counter(
+    "footcal_http_requests_total",
+    "Requests handled, by endpoint, method, and status.",
+    ("endpoint", "method", "status"),
+)
+http_duration = Histogram(
+    "footcal_http_request_duration_seconds",
+    "Time to handle a request (not including sending the response), by endpoint.",
+    ("endpoint",),
+)
+upstream_requests = Counter(
+    "footcal_upstream_requests_total",
+    "Requests sent to api-football (and for logos), by endpoint and status.",
+    ("endpoint", "status"),
+)
+upstream_duration = Histogram(
+    "footcal_upstream_request_duration_seconds",
+    "Time waiting for api-football (and for logos), by endpoint.",
+    ("endpoint",),
+)
+cache_lookups = Counter(
+    "footcal_cache_lookups_total",
+    "Cache lookups by the kind of key (e.g., team-cal) and result (hit, stale, or miss).",
+    ("kind", "result"),
+)
+db_duration = Histogram(
+    "footcal_db_query_duration_seconds",
+    "Time running DB statements, by operation.",
+    ("operation",),
+)
+calendar_render_duration = Histogram(
+    "footcal_calendar_render_seconds",
+    "Time to write a calendar's ics file; it's written once per version of the data.",
+)
+calendar_bytes = Histogram(
+    "footcal_calendar_response_bytes",
+    "Size of the calendars sent, by content encoding.",
+    ("encoding",),
+    buckets=SIZE_BUCKETS,
+)
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def instrument_engine(engine) -> None:
+    """Times every statement run by the engine."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        operation = statement.lstrip()[:6].upper()
+        db_duration.observe(
+            perf_counter() - started,
+            operation if operation in _OPERATIONS else "OTHER",
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def error(context):
+        # The statement failed, so `after` won't be called for it.
+        if context.connection is not None and context.connection.info.get(
+            "metrics_started"
+        ):
+            context.connection.info["metrics_started"].pop()
+
+
+def init(app) -> None:
+    """Records the latency and status of every request."""
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            endpoint = request.endpoint or "unmatched"
+            http_duration.observe(perf_counter() - started, endpoint)
+            http_requests.inc(endpoint, request.method, response.status_code)
+        return response
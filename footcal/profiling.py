@@ -0,0 +1,198 @@
+import json
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime
+from os import getenv
+from threading import Event, Thread, get_ident
+from time import perf_counter
+from uuid import uuid4
+
+import background
+import matches
+from flask import g, request
+
+# Get the profiling config from environment variables.
+# Nothing is hooked into the requests unless profiling is enabled.
+config = {
+    "enabled": getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes"),
+    # Requests with an "X-Footcal-Profile: <token>" header are profiled; unset to disable the header.
+    "token": getenv("PROFILING_TOKEN"),
+    # Share of the other requests that are profiled.
+    "sample_rate": float(getenv("PROFILING_SAMPLE_RATE", "0")),
+    # How often the request's stack is sampled.
+    "interval_s": float(getenv("PROFILING_INTERVAL_MS", "2")) / 1000,
+    "dir": getenv(
+        "PROFILING_DIR", os.path.join(tempfile.gettempdir(), "footcal-profiles")
+    ),
+    # The oldest profiles are deleted when there are more than this.
+    "max_profiles": int(getenv("PROFILING_MAX_PROFILES", "200")),
+}
+
+HEADER = "X-Footcal-Profile"
+
+# The phase of the request a sample is in is given by the innermost of these (module, function) in its stack.
+PHASES = {
+    ("upstream", "_get"): "upstream",
+    # Mostly waiting for upstream requests made in parallel, or for someone else's refresh.
+    ("_base", "result"): "wait",
+    ("threading", "wait"): "wait",
+    ("cache", "decode"): "deserialize",
+    ("cache", "_lookup"): "cache_read",
+    ("fixtures", "calendar_matches"): "cache_read",
+    ("fixtures", "team_matches"): "cache_read",
+    ("fixtures", "updated_since"): "cache_read",
+    ("fixtures", "moved_from_window"): "cache_read",
+    ("cache", "encode"): "serialize",
+    ("cache", "update"): "cache_write",
+    ("fixtures", "save_calendar"): "cache_write",
+    ("fixtures", "upsert"): "cache_write",
+    ("ics", "calendar"): "render",
+    ("templating", "render_template"): "render",
+    # Compressing the responses and encoding the JSON ones.
+    ("feeds", "<lambda>"): "serialize",
+    ("feeds", "encode_page"): "serialize",
+    ("provider", "response"): "serialize",
+}
+
+
+class _Sampler:
+    """Samples the stack of a thread every interval until it's stopped."""
+
+    def __init__(self, thread_id: int, interval_s: float):
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        # Maps the stacks (outermost frame first) to how many times they were sampled.
+        self.stacks: Counter[tuple[tuple[str, str], ...]] = Counter()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="footcal-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                stack.append((module, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+def _phase(stack: tuple) -> str:
+    for frame in reversed(stack):
+        phase = PHASES.get(frame)
+        if phase is not None:
+            return phase
+    return "other"
+
+
+def _collapsed(stacks: Counter) -> list[str]:
+    # The "collapsed stack" format used by flamegraph.pl and speedscope: frames separated by ";" and the count.
+    lines = Counter()
+    for stack, count in stacks.items():
+        lines[";".join(f"{module}.{function}" for module, function in stack)] += count
+    return [f"{line} {count}" for line, count in sorted(lines.items())]
+
+
+def _calendar(endpoint: str, view_args: dict) -> str:
+    if "team_id" in view_args:
+        return matches.calendar_key(True, view_args["team_id"])
+    if "comp_id" in view_args:
+        return matches.calendar_key(False, view_args["comp_id"])
+    # Other views take a type and id too (e.g., the logos).
+    if endpoint == "next_match":
+        return matches.calendar_key(view_args["type"] == "team", view_args["id"])
+    return None
+
+
+def _save(profile: dict, collapsed: list[str]) -> None:
+    os.makedirs(config["dir"], exist_ok=True)
+    name = os.path.join(config["dir"], profile["id"])
+    with open(f"{name}.folded", "w") as f:
+        f.write("\n".join(collapsed) + "\n")
+    with open(f"{name}.json", "w") as f:
+        json.dump(profile, f, indent=2)
+
+    # Only keep the most recent profiles.
+    profiles = sorted(
+        (e for e in os.scandir(config["dir"]) if e.name.endswith(".json")),
+        key=lambda e: e.stat().st_mtime,
+    )
+    for old in profiles[: max(0, len(profiles) - config["max_profiles"])]:
+        for ext in (".json", ".folded"):
+            try:
+                os.remove(old.path[: -len(".json")] + ext)
+            except FileNotFoundError:
+                pass
+
+
+def _wanted() -> bool:
+    if config["token"] and request.headers.get(HEADER) == config["token"]:
+        return True
+    return random.random() < config["sample_rate"]
+
+
+def init(app) -> None:
+    """Profiles the requests that ask for it (or a sample of them) if profiling is enabled."""
+    if not config["enabled"]:
+        return
+
+    @app.before_request
+    def start_profiler():
+        if not _wanted():
+            return
+        sampler = _Sampler(get_ident(), config["interval_s"])
+        g.profiler = (sampler, datetime.utcnow(), perf_counter())
+        sampler.start()
+
+    @app.after_request
+    def stop_profiler(response):
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return response
+        sampler, started_at, started = profiler
+        sampler.stop()
+        duration_ms = (perf_counter() - started) * 1000
+
+        # Split the request's time between the phases by their share of the samples.
+        total = sum(sampler.stacks.values())
+        phases = Counter()
+        for stack, count in sampler.stacks.items():
+            phases[_phase(stack)] += count
+        profile = {
+            "id": f"{started_at:%Y%m%dT%H%M%S}-{uuid4().hex[:8]}",
+            "started_at": started_at.isoformat(),
+            "endpoint": request.endpoint,
+            "path": request.path,
+            "calendar": _calendar(request.endpoint, request.view_args or {}),
+            "status": response.status_code,
+            "duration_ms": duration_ms,
+            "samples": total,
+            "interval_ms": config["interval_s"] * 1000,
+            "phases_ms": {
+                phase: duration_ms * count / total
+                for phase, count in phases.most_common()
+            },
+        }
+        collapsed = _collapsed(sampler.stacks)
+        background.submit(f"profile/{profile['id']}", lambda: _save(profile, collapsed))
+        response.headers[f"{HEADER}-Id"] = profile["id"]
+        return response
+
+    @app.teardown_request
+    def stop_failed_profiler(exc):
+        # The response hooks aren't called if the request failed.
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler[0].stop()
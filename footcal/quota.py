@@ -0,0 +1,232 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from os import getenv
+from threading import Lock
+from typing import Any, Iterator, Mapping, Optional
+
+import cache
+import metrics
+from custom_types import QuotaExceeded
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    select,
+)
+from sqlalchemy.exc import IntegrityError
+
+# Priorities for the upstream requests; feed refreshes are served before searches, and both are served before
+# the refreshes scheduled ahead of time.
+FEED = "feed"
+SEARCH = "search"
+SCHEDULED = "scheduled"
+
+# Get the quota config from environment variables; these should match the api-football plan.
+config = {
+    # Where the token bucket is kept: "db" shares it with every process using the DB, "local" is per process.
+    "backend": getenv("QUOTA_BACKEND", "db"),
+    "per_minute": float(getenv("QUOTA_PER_MINUTE", "30")),
+    "per_day": int(getenv("QUOTA_PER_DAY", "7500")),
+    # Share of the budget (per minute and per day) that only feed refreshes can use.
+    "feed_reserve": float(getenv("QUOTA_FEED_RESERVE", "0.25")),
+    # Share of the budget that scheduled refreshes leave for the requests made by users.
+    "scheduled_reserve": float(getenv("QUOTA_SCHEDULED_RESERVE", "0.5")),
+}
+
+# How many requests were granted/denied by priority.
+quota_stats = {
+    "granted": {FEED: 0, SEARCH: 0, SCHEDULED: 0},
+    "denied": {FEED: 0, SEARCH: 0, SCHEDULED: 0},
+}
+metrics.Exposed(
+    "footcal_quota_requests_total",
+    "API quota requested by priority, by whether it was granted.",
+    "counter",
+    ("priority", "result"),
+    lambda: [
+        ((priority, result), n)
+        for result, by_priority in quota_stats.items()
+        for priority, n in by_priority.items()
+    ],
+)
+
+# The state of the bucket, in the DB and in the local stand-in.
+_metadata = MetaData()
+quota_table = Table(
+    "api_quota",
+    _metadata,
+    Column("name", String(50), primary_key=True),
+    Column("tokens", Float, nullable=False),
+    Column("refilled_at", DateTime, nullable=False),
+    Column("day", Date, nullable=False),
+    Column("used_today", Integer, nullable=False),
+)
+_NAME = "api-football"
+
+_engine = None
+_local: dict[str, Any] = {}
+_lock = Lock()
+
+# The priority of the upstream requests made in the current context; see `priority`.
+_priority: ContextVar[str] = ContextVar("quota_priority", default=FEED)
+
+
+def _initial_state(now: datetime) -> dict[str, Any]:
+    return {
+        "tokens": config["per_minute"],
+        "refilled_at": now,
+        "day": now.date(),
+        "used_today": 0,
+    }
+
+
+def init(app) -> None:
+    """Sets up the bucket in the configured backend."""
+    global _engine
+    _local.update(_initial_state(datetime.utcnow()))
+    if config["backend"] != "db":
+        return
+
+    with app.app_context():
+        _engine = cache.db.engine
+    _metadata.create_all(_engine)
+    try:
+        with _engine.begin() as conn:
+            if (
+                conn.execute(
+                    select(quota_table.c.name).where(quota_table.c.name == _NAME)
+                ).first()
+                is None
+            ):
+                conn.execute(
+                    quota_table.insert().values(
+                        name=_NAME, **_initial_state(datetime.utcnow())
+                    )
+                )
+    except IntegrityError:
+        # Another process created it first.
+        pass
+
+
+def _refill(state: dict[str, Any], now: datetime) -> None:
+    elapsed_s = (now - state["refilled_at"]).total_seconds()
+    state["tokens"] = min(
+        config["per_minute"],
+        state["tokens"] + max(0, elapsed_s) * config["per_minute"] / 60,
+    )
+    state["refilled_at"] = now
+    # api-football resets the daily quota at midnight UTC.
+    if state["day"] != now.date():
+        state["day"] = now.date()
+        state["used_today"] = 0
+
+
+def _reserve(priority: str) -> float:
+    # Searches can't use the share of the budget reserved for feeds, and scheduled refreshes leave even more.
+    if priority == SEARCH:
+        return config["feed_reserve"]
+    if priority == SCHEDULED:
+        return max(config["feed_reserve"], config["scheduled_reserve"])
+    return 0
+
+
+def _take(state: dict[str, Any], priority: str, now: datetime) -> bool:
+    _refill(state, now)
+    reserve = _reserve(priority)
+    min_tokens = 1 + reserve * config["per_minute"]
+    max_used = config["per_day"] * (1 - reserve) - 1
+    if state["tokens"] < min_tokens or state["used_today"] > max_used:
+        return False
+    state["tokens"] -= 1
+    state["used_today"] += 1
+    return True
+
+
+def _apply_headers(
+    state: dict[str, Any], day_remaining: Optional[int], minute_remaining: Optional[int]
+) -> None:
+    # Trust api-football's numbers over ours when they say we have less left.
+    if day_remaining is not None:
+        state["used_today"] = max(
+            state["used_today"], config["per_day"] - day_remaining
+        )
+    if minute_remaining is not None:
+        state["tokens"] = min(state["tokens"], minute_remaining)
+
+
+def _update_state(fn, *args) -> Any:
+    """Applies `fn` to the bucket's state in the configured backend, atomically."""
+    now = datetime.utcnow()
+    if _engine is None:
+        with _lock:
+            return fn(_local, *args, now)
+
+    with _engine.begin() as conn:
+        row = conn.execute(
+            select(quota_table).where(quota_table.c.name == _NAME).with_for_update()
+        ).first()
+        state = dict(row._mapping)
+        result = fn(state, *args, now)
+        conn.execute(
+            quota_table.update().where(quota_table.c.name == _NAME).values(**state)
+        )
+    return result
+
+
+@contextmanager
+def priority(name: str) -> Iterator[None]:
+    """Makes the upstream requests in the block (and the ones it starts in `matches`' pool) use the given priority."""
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    """Returns the priority of the upstream requests made in the current context (feed by default)."""
+    return _priority.get()
+
+
+def acquire(priority: str) -> None:
+    """Takes one request from the budget, or raises QuotaExceeded if there's none left for this priority."""
+    granted = _update_state(_take, priority)
+    with _lock:
+        quota_stats["granted" if granted else "denied"][priority] += 1
+    if not granted:
+        raise QuotaExceeded(f"no API quota left for {priority} requests")
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def record_response(headers: Mapping[str, str]) -> None:
+    """Syncs the budget with the rate limit headers sent by api-football."""
+    day_remaining = _header(headers, "x-ratelimit-requests-remaining")
+    minute_remaining = _header(headers, "x-ratelimit-remaining")
+    if day_remaining is None and minute_remaining is None:
+        return
+    _update_state(
+        lambda state, now: _apply_headers(state, day_remaining, minute_remaining)
+    )
+
+
+def remaining_today(priority: str = FEED) -> int:
+    """Returns how many requests are left in today's budget for requests with the given priority."""
+
+    def get(state, now):
+        _refill(state, now)
+        max_used = config["per_day"] * (1 - _reserve(priority))
+        return max(0, int(max_used) - state["used_today"])
+
+    return _update_state(get)
@@ -0,0 +1,169 @@
+import heapq
+import logging
+from datetime import date, datetime, timedelta
+from os import getenv
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Optional
+
+import background
+import matches
+import quota
+from custom_types import Competition
+
+logger = logging.getLogger(__name__)
+
+# Get the scheduler config from environment variables.
+config = {
+    "enabled": getenv("SCHEDULER_ENABLED", "true").lower() in ("1", "true", "yes"),
+    # How often the scheduler looks for calendars that are due.
+    "tick_s": float(getenv("SCHEDULER_TICK_S", "60")),
+    # Calendars that were not polled for this long are not refreshed until someone asks for them again.
+    "idle_after": timedelta(hours=float(getenv("SCHEDULER_IDLE_AFTER_H", "72"))),
+    # How many refreshes can be started per hour; by default, as many as the share of the daily API quota
+    # that scheduled refreshes can use allows.
+    "max_refreshes_per_h": getenv("SCHEDULER_MAX_REFRESHES_PER_H"),
+}
+
+# The most API calls a refresh can make: the team's info and its next and last matches, or its competitions'
+# fixtures (which are shared by every team in them).
+CALLS_PER_REFRESH = 3
+
+# Maps the cache key of a calendar to when it was last requested.
+_last_polled: dict[str, datetime] = {}
+_lock = Lock()
+
+
+def record_poll(key: str) -> None:
+    """Marks the calendar as being used, so it's kept up to date."""
+    with _lock:
+        _last_polled[key] = datetime.utcnow()
+
+
+def refresh_interval(cal_data: dict, now: datetime) -> timedelta:
+    """Decides how often the calendar should be refreshed based on when its matches happen."""
+    now_ts = (now - datetime(1970, 1, 1)).total_seconds()
+    next_kickoff = None
+    # Every match is checked since the calendar needs the shortest interval of any of them
+    # (e.g., a match that just finished can be followed by one that is being played).
+    interval = None
+    for m in cal_data["matches"]:
+        since_kickoff = timedelta(seconds=now_ts - m.match_utc_ts)
+        # Keep the score up to date while a match is being played.
+        if m.status in matches.LIVE_STATUSES or (
+            timedelta(0) <= since_kickoff <= matches.MATCH_WINDOW
+            and m.status not in matches.FINISHED_STATUSES
+        ):
+            return timedelta(minutes=15)
+        # Pick up the final results of matches that just finished.
+        if timedelta(0) <= since_kickoff <= 2 * matches.MATCH_WINDOW:
+            interval = timedelta(hours=1)
+        if since_kickoff < timedelta(0):
+            until_kickoff = -since_kickoff
+            next_kickoff = min(next_kickoff or until_kickoff, until_kickoff)
+
+    if interval is not None:
+        return interval
+
+    # Kickoff times and venues tend to change close to the match.
+    if next_kickoff is not None and next_kickoff <= timedelta(days=1):
+        return timedelta(hours=3)
+
+    # Off-season: the competition is over or there are no matches coming up.
+    info = cal_data["info"]
+    if (
+        (isinstance(info, Competition) and info.season_end < date.today().isoformat())
+        or next_kickoff is None
+        or next_kickoff > timedelta(days=30)
+    ):
+        return timedelta(weeks=1)
+
+    return matches.CALENDAR_MAX_AGE
+
+
+def plan(now: datetime) -> list[tuple[datetime, str, timedelta]]:
+    """Returns the (due time, cache key, refresh interval) of the calendars that were polled recently, by due time."""
+    with _lock:
+        polled = [k for k, t in _last_polled.items() if t + config["idle_after"] >= now]
+
+    jobs = []
+    for key in polled:
+        cal_data, unused_fresh, ts = matches.query_calendar(
+            key, max_age=timedelta(0), record=False
+        )
+        if cal_data is None:
+            continue
+        interval = refresh_interval(cal_data, now)
+        jobs.append((ts + interval, key, interval))
+    heapq.heapify(jobs)
+    return [heapq.heappop(jobs) for _ in range(len(jobs))]
+
+
+class _TokenBucket:
+    def __init__(self, per_hour: float):
+        self.capacity = max(1.0, per_hour / 60)
+        self.rate_s = per_hour / 3600
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+    def take(self) -> bool:
+        now = monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate_s
+        )
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def max_refreshes_per_h() -> float:
+    """Returns how many refreshes can be started per hour."""
+    if config["max_refreshes_per_h"] is not None:
+        return float(config["max_refreshes_per_h"])
+    reserve = max(quota.config["feed_reserve"], quota.config["scheduled_reserve"])
+    return quota.config["per_day"] * (1 - reserve) / 24 / CALLS_PER_REFRESH
+
+
+_bucket = _TokenBucket(max_refreshes_per_h())
+
+
+def _refresh(team: bool, id: str, interval: timedelta) -> None:
+    # Scheduled refreshes only use the API quota that's not needed by the requests made by users.
+    with quota.priority(quota.SCHEDULED):
+        matches.refresh_entry(team, id, max_age=interval)
+
+
+def run_once(now: Optional[datetime] = None) -> int:
+    """Queues the refreshes that are due (within the rate limit) and returns how many were queued."""
+    now = now or datetime.utcnow()
+    queued = 0
+    # Don't queue refreshes that would be denied anyway.
+    budget = quota.remaining_today(quota.SCHEDULED) // CALLS_PER_REFRESH
+    for due, key, interval in plan(now):
+        if due > now or queued >= budget or not _bucket.take():
+            break
+        kind, _, id = key.partition("/")
+        team = kind == "team-cal"
+        if background.submit(
+            key,
+            lambda team=team, id=id, interval=interval: _refresh(team, id, interval),
+        ):
+            queued += 1
+    return queued
+
+
+def _loop(app) -> None:
+    while True:
+        try:
+            with app.app_context():
+                run_once()
+        except Exception:
+            logger.exception("failed to schedule calendar refreshes")
+        sleep(config["tick_s"])
+
+
+def start(app) -> None:
+    """Starts refreshing the polled calendars in a daemon thread."""
+    Thread(target=_loop, args=(app,), name="footcal-scheduler", daemon=True).start()
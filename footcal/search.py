@@ -3,18 +3,28 @@ from datetime import timedelta
 from typing import List
 
 import cache
-import requests
-from auth import APIURL, HEADERS, REQUEST_TIMEOUT_S
-from custom_types import Competition, Team
+import quota
+import search_index
+import singleflight
+import upstream
+from custom_types import (
+    Competition,
+    QuotaExceeded,
+    SearchQuotaExceeded,
+    Team,
+    UpstreamBusy,
+    UpstreamError,
+)
 
 
 def get_teams(user_query: str) -> str:
-    resp = requests.get(
-        f"{APIURL}/teams",
+    resp = upstream.api_get(
+        "teams",
         params={"search": user_query},
-        headers=HEADERS,
-        timeout=REQUEST_TIMEOUT_S,
+        priority=quota.SEARCH,
     )
+    # Don't cache errors (e.g., a query the API rejects) as searches without results.
+    upstream.check(resp)
     return resp.text
 
 
@@ -34,14 +44,57 @@ def parse_teams(tresp: str) -> List[Team]:
     ]
 
 
+# How long a cached search is considered fresh.
+SEARCH_MAX_AGE = timedelta(days=30)
+
+
 def search_teams(user_query: str) -> List[Team]:
+    # Answer from the local index if a previous search already got every result the API would give us.
+    query = search_index.normalize(user_query)
+    if len(query) < search_index.MIN_QUERY_LENGTH:
+        # The API rejects short queries, so only look for the names we know.
+        return search_index.search(search_index.TEAM, query)
+    if search_index.covers(search_index.TEAM, query, SEARCH_MAX_AGE):
+        return search_index.search(search_index.TEAM, query)
+
     # Check if we have this search cached.
-    lookup_key = f"team-search/{user_query}"
-    cached, fresh = cache.query(lookup_key, max_age=timedelta(days=30))
+    lookup_key = f"team-search/{query}"
+    cached, fresh = cache.query(lookup_key, max_age=SEARCH_MAX_AGE)
+    if fresh:
+        return cached
+
+    # Only one caller runs the same search at a time; the others wait for it or get the stale results.
+    try:
+        results = singleflight.run(
+            lookup_key, lambda: _refresh_teams_search(query), stale=cached
+        )
+    except QuotaExceeded as e:
+        # Fall back to the old results or the closest names we know, if we have them.
+        results = cached or search_index.search(search_index.TEAM, query)
+        if results:
+            return results
+        raise SearchQuotaExceeded(str(e)) from e
+    except (UpstreamBusy, UpstreamError):
+        results = cached or search_index.search(search_index.TEAM, query)
+        if results:
+            return results
+        raise
+
+    # The API doesn't handle typos, so suggest the closest names we know instead of nothing.
+    return results or search_index.search(search_index.TEAM, query)
+
+
+def _refresh_teams_search(query: str) -> List[Team]:
+    # Check the DB again in case another process ran this search while we waited.
+    lookup_key = f"team-search/{query}"
+    cached, fresh, unused_ts = cache.query_entry(
+        lookup_key, max_age=SEARCH_MAX_AGE, use_l1=False, record=False
+    )
     if fresh:
         return cached
 
-    tresp = get_teams(user_query)
+    # Send the normalized query so the results match the key they're cached under.
+    tresp = get_teams(query)
     new_data = parse_teams(tresp)
 
     # Add the search results to the cache.
@@ -51,12 +104,13 @@ def search_teams(user_query: str) -> List[Team]:
 
 
 def get_comps(user_query: str) -> str:
-    resp = requests.get(
-        f"{APIURL}/leagues",
+    resp = upstream.api_get(
+        "leagues",
         params={"search": user_query},
-        headers=HEADERS,
-        timeout=REQUEST_TIMEOUT_S,
+        priority=quota.SEARCH,
     )
+    # Don't cache errors (e.g., a query the API rejects) as searches without results.
+    upstream.check(resp)
     return resp.text
 
 
@@ -79,13 +133,52 @@ def parse_comps(tresp: str) -> List[Competition]:
 
 
 def search_comps(user_query: str) -> List[Competition]:
+    # Answer from the local index if a previous search already got every result the API would give us.
+    query = search_index.normalize(user_query)
+    if len(query) < search_index.MIN_QUERY_LENGTH:
+        # The API rejects short queries, so only look for the names we know.
+        return search_index.search(search_index.COMP, query)
+    if search_index.covers(search_index.COMP, query, SEARCH_MAX_AGE):
+        return search_index.search(search_index.COMP, query)
+
     # Check if we have this search cached.
-    lookup_key = f"comp-search/{user_query}"
-    cached, fresh = cache.query(lookup_key, max_age=timedelta(days=30))
+    lookup_key = f"comp-search/{query}"
+    cached, fresh = cache.query(lookup_key, max_age=SEARCH_MAX_AGE)
+    if fresh:
+        return cached
+
+    # Only one caller runs the same search at a time; the others wait for it or get the stale results.
+    try:
+        results = singleflight.run(
+            lookup_key, lambda: _refresh_comps_search(query), stale=cached
+        )
+    except QuotaExceeded as e:
+        # Fall back to the old results or the closest names we know, if we have them.
+        results = cached or search_index.search(search_index.COMP, query)
+        if results:
+            return results
+        raise SearchQuotaExceeded(str(e)) from e
+    except (UpstreamBusy, UpstreamError):
+        results = cached or search_index.search(search_index.COMP, query)
+        if results:
+            return results
+        raise
+
+    # The API doesn't handle typos, so suggest the closest names we know instead of nothing.
+    return results or search_index.search(search_index.COMP, query)
+
+
+def _refresh_comps_search(query: str) -> List[Competition]:
+    # Check the DB again in case another process ran this search while we waited.
+    lookup_key = f"comp-search/{query}"
+    cached, fresh, unused_ts = cache.query_entry(
+        lookup_key, max_age=SEARCH_MAX_AGE, use_l1=False, record=False
+    )
     if fresh:
         return cached
 
-    tresp = get_comps(user_query)
+    # Send the normalized query so the results match the key they're cached under.
+    tresp = get_comps(query)
     new_data = parse_comps(tresp)
 
     # Add the search results to the cache.
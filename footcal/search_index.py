@@ -0,0 +1,219 @@
+import logging
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Any, List
+
+import background
+import cache
+from custom_types import Team
+from sqlalchemy.sql import select
+
+logger = logging.getLogger(__name__)
+
+# Kinds of entities we can search.
+TEAM = "team"
+COMP = "comp"
+
+# Names that don't contain the query are shown if they have this share of its trigrams (e.g., typos).
+MIN_SIMILARITY = 0.5
+MAX_SIMILAR_RESULTS = 10
+# api-football rejects searches shorter than this.
+MIN_QUERY_LENGTH = 3
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercases the text and removes accents, punctuation, and extra whitespace."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return _NON_ALNUM.sub(" ", stripped).strip()
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class _Index:
+    """Names of the teams/competitions we've seen, with the queries we already sent to the API."""
+
+    def __init__(self):
+        self.entities: dict[int, Any] = {}
+        self.names: dict[int, str] = {}
+        self.postings: dict[str, set[int]] = defaultdict(set)
+        # Maps the normalized queries we searched in the API to when we did it, for the searches that can
+        # answer other queries (see `covering`).
+        self.searches: dict[str, datetime] = {}
+        self.lock = Lock()
+
+    def add(self, entity: Any) -> None:
+        name = normalize(entity.name or "")
+        with self.lock:
+            old_name = self.names.get(entity.id)
+            if old_name is not None and old_name != name:
+                for t in _trigrams(old_name):
+                    self.postings[t].discard(entity.id)
+            self.entities[entity.id] = entity
+            self.names[entity.id] = name
+            for t in _trigrams(name):
+                self.postings[t].add(entity.id)
+
+    def add_search(self, query: str, ts: datetime) -> None:
+        with self.lock:
+            if ts > self.searches.get(query, datetime.min):
+                self.searches[query] = ts
+
+    def covers(self, query: str, max_age: timedelta) -> bool:
+        """Returns whether the results of a fresh API search include every result the API has for the query.
+
+        The API matches the names (and countries) that contain the query, so a search for any part of the query
+        covers it as long as no country matched that part.
+        """
+        oldest = datetime.utcnow() - max_age
+        with self.lock:
+            return any(
+                self.searches.get(query[i:j], datetime.min) >= oldest
+                for i in range(len(query))
+                for j in range(i + 1, len(query) + 1)
+            )
+
+    def search(self, query: str) -> List[Any]:
+        """Returns the entities that best match the query, best first.
+
+        Every name that contains the query is returned, plus a few that are similar to it (e.g., typos).
+        """
+        if not query:
+            return []
+        query_trigrams = _trigrams(query)
+        with self.lock:
+            if not query_trigrams:
+                # Too short for trigrams; only look for names with a word that starts with it.
+                scored = [
+                    (-0.8, len(name), name, id)
+                    for id, name in self.names.items()
+                    if any(token.startswith(query) for token in name.split())
+                ]
+                scored.sort()
+                return [self.entities[id] for *unused, id in scored]
+
+            # Count how many of the query's trigrams each name has.
+            common = Counter()
+            for t in query_trigrams:
+                common.update(self.postings.get(t, ()))
+
+            scored = []
+            similar = []
+            for id, count in common.items():
+                name = self.names[id]
+                if count == len(query_trigrams) and query in name:
+                    scored.append((-_score(query, name), len(name), name, id))
+                elif count / len(query_trigrams) >= MIN_SIMILARITY:
+                    similar.append((-count / len(query_trigrams), len(name), name, id))
+            scored.sort()
+            similar.sort()
+            return [
+                self.entities[id]
+                for *unused, id in scored + similar[:MAX_SIMILAR_RESULTS]
+            ]
+
+
+def _score(query: str, name: str) -> float:
+    # Rank the names that contain the query by how well they match it.
+    if name == query:
+        return 1.0
+    if name.startswith(query):
+        return 0.9
+    tokens = name.split()
+    if all(any(t.startswith(q) for t in tokens) for q in query.split()):
+        return 0.8
+    return 0.7
+
+
+def covering(query: str, results: List[Any]) -> bool:
+    """Returns whether an API search for the (normalized) query can answer the queries that contain it.
+
+    The API rejects queries that are too short, and it also returns everything from the countries that contain
+    the query, which we can't find by name; searches like that can only answer themselves.
+    """
+    if len(query) < MIN_QUERY_LENGTH:
+        return False
+    for entity in results:
+        country = entity.country if isinstance(entity, Team) else entity.country_name
+        if query not in normalize(entity.name or "") or query in normalize(
+            country or ""
+        ):
+            return False
+    return True
+
+
+_indexes = {TEAM: _Index(), COMP: _Index()}
+_ready = False
+
+# The cache entries with teams/competitions, by the kind of their key.
+_SEARCH_KINDS = {"team-search": TEAM, "comp-search": COMP}
+_CALENDAR_KINDS = {"team-cal": TEAM, "comp-cal": COMP}
+
+
+def _add_entry(key: str, value: Any, ts: datetime) -> None:
+    kind, _, rest = key.partition("/")
+    if not value:
+        return
+    if kind in _SEARCH_KINDS:
+        index = _indexes[_SEARCH_KINDS[kind]]
+        for entity in value:
+            index.add(entity)
+        query = normalize(rest)
+        if covering(query, value):
+            index.add_search(query, ts)
+    elif kind in _CALENDAR_KINDS:
+        _indexes[_CALENDAR_KINDS[kind]].add(value["info"])
+
+
+def _build() -> None:
+    global _ready
+    kinds = list(_SEARCH_KINDS) + list(_CALENDAR_KINDS)
+    stmt = select(cache.table.objkey, cache.table.data).where(
+        cache.table.kind.in_(kinds)
+    )
+    for key, raw in cache.db.session.execute(stmt):
+        value, ts = cache.decode(raw)
+        _add_entry(key, value, ts)
+    _ready = True
+    logger.info(
+        f"search index ready: {len(_indexes[TEAM].entities)} teams, {len(_indexes[COMP].entities)} competitions"
+    )
+
+
+def init(app, wait: bool = False) -> None:
+    """Builds the index from the cached searches and calendars, in the background unless asked to wait for it."""
+    if wait:
+        with app.app_context():
+            _build()
+    else:
+        background.submit("search-index/build", _build)
+
+
+def covers(kind: str, query: str, max_age: timedelta) -> bool:
+    """Returns whether the (normalized) query can be answered without asking the API."""
+    return _ready and _indexes[kind].covers(query, max_age)
+
+
+def search(kind: str, query: str) -> List[Any]:
+    """Returns the teams/competitions that best match the (normalized) query, best first."""
+    return _indexes[kind].search(query)
+
+
+def on_update(key: str) -> None:
+    """Adds the teams/competitions in new searches and calendars to the index."""
+    kind = key.partition("/")[0]
+    if kind not in _SEARCH_KINDS and kind not in _CALENDAR_KINDS:
+        return
+    # The entry was just written, so it's in the L1 cache.
+    value, ts = cache.latest(key)
+    _add_entry(key, value, ts)
+
+
+cache.update_listeners.append(on_update)
@@ -0,0 +1,94 @@
+from concurrent.futures import Future
+from os import getenv
+from threading import BoundedSemaphore, Lock, local
+from typing import Callable, Optional, TypeVar
+
+import cache
+import upstream
+from custom_types import UpstreamBusy
+
+T = TypeVar("T")
+
+# How long to wait for another process/host to finish refreshing an entry when we have nothing to serve.
+LOCK_WAIT_S = 2 * sum(upstream.timeout())
+# How long a refresh can keep the entry locked, in case its process dies before releasing it.
+LOCK_HOLD_S = 2 * LOCK_WAIT_S
+
+# Refreshes currently running in this process, by cache key.
+_inflight: dict[str, Future] = {}
+_lock = Lock()
+
+# Get the concurrency config from environment variables.
+config = {
+    # How many refreshes (which wait for the API) can run at the same time in this process.
+    # The others wait for their turn so a burst of misses can't take every worker from the cached requests.
+    "max_concurrent": int(getenv("REFRESH_MAX_CONCURRENT", "8")),
+    # How long a refresh waits for its turn before giving up; it doesn't wait if there's a stale value to serve.
+    "queue_timeout_s": float(getenv("REFRESH_QUEUE_TIMEOUT_S", "30")),
+}
+_slots = BoundedSemaphore(config["max_concurrent"])
+# How many refreshes the current thread is running; nested refreshes use the slot of the outermost one.
+_depth = local()
+
+
+def _acquire_slot(wait_s: float) -> bool:
+    depth = getattr(_depth, "value", 0)
+    if depth == 0 and not _slots.acquire(timeout=wait_s):
+        return False
+    _depth.value = depth + 1
+    return True
+
+
+def _release_slot() -> None:
+    _depth.value -= 1
+    if _depth.value == 0:
+        _slots.release()
+
+
+def run(key: str, refresh: Callable[[], T], stale: Optional[T] = None) -> T:
+    """Runs `refresh` for the given cache key unless someone else is already doing it.
+
+    Only the first caller in this process runs the refresh; concurrent callers get the stale value if there's one,
+    or wait for the refreshed value otherwise. The refresh also holds a lock on the key in the DB, so processes
+    on other hosts coordinate too; `refresh` should check the cache again since another host could have
+    refreshed the entry while we waited for the lock.
+
+    Only a few refreshes run at the same time; raises UpstreamBusy if there's no stale value to serve and it's not
+    our turn within the queue timeout.
+    """
+    # Don't hold on to a DB connection while we wait for someone else or for our turn.
+    cache.release_connection()
+    with _lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[key] = Future()
+
+    if not is_leader:
+        if stale is not None:
+            return stale
+        return future.result()
+
+    try:
+        if not _acquire_slot(0 if stale is not None else config["queue_timeout_s"]):
+            if stale is None:
+                raise UpstreamBusy(f"too many refreshes running to refresh {key}")
+            result = stale
+        else:
+            try:
+                # Don't wait for another host's refresh if we can serve the stale value.
+                wait_s = 0 if stale is not None else LOCK_WAIT_S
+                with cache.lock(key, wait_s, LOCK_HOLD_S) as acquired:
+                    # If we timed out waiting for the lock, the other host is probably stuck so we try refreshing anyway.
+                    result = refresh() if acquired or stale is None else stale
+            finally:
+                _release_slot()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            del _inflight[key]
@@ -0,0 +1,115 @@
+from os import getenv
+from random import uniform
+from time import perf_counter
+from typing import Optional
+
+import cache
+import metrics
+import quota
+import requests
+from auth import APIURL, HEADERS
+from custom_types import UpstreamError
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# Get the upstream client config from environment variables.
+config = {
+    "connect_timeout_s": float(getenv("UPSTREAM_CONNECT_TIMEOUT_S", "5")),
+    "read_timeout_s": float(getenv("UPSTREAM_READ_TIMEOUT_S", "30")),
+    # How many connections are kept open for each host.
+    "pool_size": int(getenv("UPSTREAM_POOL_SIZE", "10")),
+    "retries": int(getenv("UPSTREAM_RETRIES", "2")),
+    "backoff_s": float(getenv("UPSTREAM_BACKOFF_S", "0.5")),
+}
+
+# Where the logos are downloaded from.
+LOGO_URL = getenv("LOGO_URL", "https://media.api-sports.io/football")
+
+
+class _JitteredRetry(Retry):
+    """Retry with exponential backoff plus up to the same amount of random jitter."""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return backoff + uniform(0, backoff)
+
+
+def _create_session() -> requests.Session:
+    retry = _JitteredRetry(
+        total=config["retries"],
+        backoff_factor=config["backoff_s"],
+        # Rate limited requests (429) aren't retried: the retries wouldn't be charged to the quota, and waiting
+        # for the Retry-After would hold the worker.
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET",),
+        raise_on_status=False,
+    )
+    # Keep the connections alive and reuse them across requests (and threads).
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=config["pool_size"],
+        pool_block=True,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+session = _create_session()
+
+
+def timeout() -> tuple[float, float]:
+    """Returns the (connect, read) timeouts used for upstream requests."""
+    return config["connect_timeout_s"], config["read_timeout_s"]
+
+
+def _get(endpoint: str, url: str, **kwargs) -> requests.Response:
+    cache.release_connection()
+    # Record how long each endpoint takes and how it answers, including the retries.
+    start = perf_counter()
+    status = "error"
+    try:
+        resp = session.get(url, timeout=timeout(), **kwargs)
+        status = resp.status_code
+        return resp
+    finally:
+        metrics.upstream_duration.observe(perf_counter() - start, endpoint)
+        metrics.upstream_requests.inc(endpoint, status)
+
+
+def api_get(
+    endpoint: str, params: dict, priority: Optional[str] = None
+) -> requests.Response:
+    """Sends a GET request to the given api-football endpoint (e.g., "fixtures").
+
+    The priority defaults to the one set with `quota.priority` (a feed refresh if there's none).
+    Raises QuotaExceeded if there's no API quota left for requests with this priority.
+    """
+    quota.acquire(priority or quota.current_priority())
+    resp = _get(endpoint, f"{APIURL}/{endpoint}", params=params, headers=HEADERS)
+    quota.record_response(resp.headers)
+    return resp
+
+
+def check(resp: requests.Response) -> None:
+    """Raises UpstreamError if api-football couldn't answer the request.
+
+    Note that api-football reports most errors (e.g., a bad parameter) with a 200 status and an empty response.
+    """
+    if resp.status_code != 200:
+        raise UpstreamError(f"api-football answered with status {resp.status_code}")
+    try:
+        errors = resp.json().get("errors")
+    except ValueError as e:
+        raise UpstreamError("api-football sent an invalid response") from e
+    if errors:
+        raise UpstreamError(f"api-football answered with errors: {errors}")
+
+
+def logo_get(type: str, id: str) -> requests.Response:
+    """Downloads the logo for the given team/competition."""
+    return _get(
+        "logo", f"{LOGO_URL}/{'teams' if type == 'team' else 'leagues'}/{id}.png"
+    )
@@ -0,0 +1,2 @@
+# Production entry point; run it with `gunicorn -c footcal/gunicorn.conf.py` (see the README).
+from app import app